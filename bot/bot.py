@@ -1,15 +1,28 @@
+import asyncio
 import os
+import time
+from contextlib import contextmanager
 from logging import getLogger, Logger
-from typing import Optional, List
+from typing import Dict, Optional, List, Tuple
 
 import discord
 import redis.asyncio as redis
-from aredis_om import Migrator
-from redis_om import NotFoundError
-from models import Member, Role
+from models import Guild, Member, Role
+from indexes import migrate_indexes
+from cache import InviteCache
+from schema import DAY, GuildSchema
+from teardown import Teardown
+from writer import EventWriter
+import leaderboard
+import metrics
+import pools
+import retention
+from cogs.backfill import MemberBackfill
+from cogs.warmup import WarmUp
 from discord.ext import commands
-import pickle
-import base64
+import hashlib
+import json
+import uuid
 
 try:
     from dotenv import load_dotenv
@@ -26,8 +39,9 @@ class Bot(commands.Bot):
         intents: discord.Intents,
         guild_id: Optional[int] = None,
         extensions: List[str] = None,
+        **options,
     ):
-        super().__init__(command_prefix="sq.id!!", intents=intents)
+        super().__init__(command_prefix="sq.id!!", intents=intents, **options)
 
         if guild_id is not None:
             self.guild = discord.Object(id=guild_id)
@@ -35,28 +49,199 @@ class Bot(commands.Bot):
             self.guild = None
 
         self.redis: redis.Redis = None
+        self.bulk: redis.Redis = None
+        self.cache: Optional[pools.ClientCache] = None
+        self.invites: InviteCache = None
+        self.schema: GuildSchema = None
+        self.teardown: Teardown = None
+        self.index_tasks: List[asyncio.Task] = []
+        self.writer: EventWriter = None
+        self.backfill: MemberBackfill = None
+        self.metrics_enabled = os.getenv("METRICS", "").lower() in ("1", "true", "yes")
+        self.metrics_tasks: List[asyncio.Task] = []
+        # only the first process of a cluster syncs the command tree
+        self.cluster_id = 0
         self.exts = extensions or []
         self.log: Logger = getLogger("discord.app")
+        # seconds spent in every startup phase, logged once ready
+        self.startup: Dict[str, float] = {}
+        self.created = time.perf_counter()
+        # this process' invite tables, state other processes left doesn't count
+        self.session = uuid.uuid4().hex
+        self.setup_done = self.created
 
-    async def setup_hook(self):
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup[name] = time.perf_counter() - start
+
+    async def start_services(self) -> None:
+        """Connect to redis and start the caches and writers the cogs rely on"""
         # Initialize database connection
-        self.redis = redis.Redis(
+        client = metrics.InstrumentedRedis if self.metrics_enabled else redis.Redis
+        connection = dict(
             host=os.getenv("REDIS_HOST"),
-            port=os.getenv("REDIS_PORT", "6379"),
+            port=int(os.getenv("REDIS_PORT", "6379")),
             password=os.getenv("REDIS_PASSWORD"),
             decode_responses=True,
         )
-        await Migrator().run()
+        timeout = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+        # handlers and the writer, latency critical
+        self.redis = client(
+            connection_pool=pools.TimedPool(
+                "hot",
+                max_connections=int(os.getenv("REDIS_HOT_CONNECTIONS", "32")),
+                timeout=timeout,
+                **connection,
+            )
+        )
+        # warm-up, backfill, teardown and maintenance jobs
+        self.bulk = client(
+            connection_pool=pools.TimedPool(
+                "bulk",
+                max_connections=int(os.getenv("REDIS_BULK_CONNECTIONS", "8")),
+                timeout=timeout,
+                **connection,
+            )
+        )
+        if os.getenv("REDIS_CLIENT_CACHE", "1") != "0":
+            self.cache = pools.ClientCache(
+                connection,
+                maxsize=int(os.getenv("REDIS_CLIENT_CACHE_SIZE", "10000")),
+                connections=int(os.getenv("REDIS_CLIENT_CACHE_CONNECTIONS", "4")),
+                timeout=timeout,
+            )
+            await self.cache.start()
+        self.invites = InviteCache(
+            self.redis, interval=float(os.getenv("INVITE_FLUSH_INTERVAL", "1"))
+        )
+        with metrics.attributed("InviteCache"):
+            self.invites.start()
+        self.schema = GuildSchema(self.redis)
+        self.writer = EventWriter(
+            self.redis,
+            interval=float(os.getenv("WRITER_INTERVAL", "0.005")),
+            batch=int(os.getenv("WRITER_BATCH", "500")),
+            maxsize=int(os.getenv("WRITER_QUEUE", "10000")),
+        )
+        with metrics.attributed("EventWriter"):
+            self.writer.start()
+        self.teardown = Teardown(
+            self.bulk,
+            batch=int(os.getenv("TEARDOWN_BATCH", "500")),
+            rate=float(os.getenv("TEARDOWN_RATE", "5000")),
+        )
+        self.backfill = MemberBackfill(
+            self.bulk,
+            log=self.log.getChild("MemberBackfill"),
+            chunk=int(os.getenv("BACKFILL_CHUNK", "1000")),
+            concurrency=int(os.getenv("BACKFILL_CONCURRENCY", "4")),
+            rate=float(os.getenv("BACKFILL_RATE", "20")),
+        )
         ping = await self.redis.ping()
         self.log.info("Connected to redis (%s)", ping)
+        with self.phase("indexes"):
+            self.index_tasks.extend(await migrate_indexes(self.redis, [Member, Role, Guild]))
+        if self.metrics_enabled:
+            await self.start_metrics()
+
+    async def start_metrics(self) -> None:
+        metrics.instrument_http(self.http)
+        metrics.instrument_ratelimits()
+        metrics.metrics.gauge("writer_queue_depth", self.writer.queue.qsize)
+        metrics.metrics.gauge("writer_flushes", lambda: self.writer.flushes)
+        metrics.metrics.gauge(
+            "writer_batch_size_p50", lambda: metrics.quantile(self.writer.batch_sizes, 0.5)
+        )
+        metrics.metrics.gauge(
+            "writer_batch_size_max", lambda: max(self.writer.batch_sizes, default=0)
+        )
+        metrics.metrics.gauge(
+            "writer_flush_p50_seconds", lambda: metrics.quantile(self.writer.flush_times, 0.5)
+        )
+        metrics.metrics.gauge(
+            "writer_flush_p99_seconds", lambda: metrics.quantile(self.writer.flush_times, 0.99)
+        )
+        metrics.metrics.gauge(
+            "invite_cache_dirty", lambda: sum(map(len, self.invites.dirty.values()))
+        )
+        metrics.metrics.gauge("joins_pending", self._pending_joins)
+        metrics.metrics.collect("rest_fallbacks_total", "site", self.rest_fallbacks)
+        metrics.metrics.gauge("autocomplete_p99_seconds", lambda: self.autocomplete_percentile(0.99))
+        metrics.metrics.gauge("event_loop_tasks", lambda: len(asyncio.all_tasks()))
+        clients = [self.redis, self.bulk] + ([self.cache.reader] if self.cache else [])
+        for client in clients:
+            pool = client.connection_pool
+            metrics.metrics.gauge(f"redis_{pool.name}_pool_wait_seconds", lambda p=pool: p.wait_seconds)
+            metrics.metrics.gauge(f"redis_{pool.name}_pool_max_wait_seconds", lambda p=pool: p.max_wait)
+        if self.cache is not None:
+            metrics.metrics.gauge("client_cache_hit_rate", lambda: self.cache.hit_rate)
+            metrics.metrics.gauge("client_cache_keys", lambda: len(self.cache.values))
+            metrics.metrics.gauge("client_cache_invalidations", lambda: self.cache.invalidations)
+        self.metrics_tasks.append(asyncio.create_task(metrics.loop_lag()))
+        host = os.getenv("METRICS_HOST", "127.0.0.1")
+        port = int(os.getenv("METRICS_PORT", "9108")) + self.cluster_id
+        await metrics.serve(host, port)
+        self.log.info("Serving metrics on http://%s:%s/metrics", host, port)
+
+    def _pending_joins(self) -> int:
+        cog = self.get_cog("MemberTracking")
+        return sum(map(len, cog.joins.pending.values())) if cog else 0
+
+    def autocomplete_percentile(self, p: float) -> float:
+        cog = self.get_cog("MemberTracking")
+        return cog.autocomplete.percentile(p) if cog else 0.0
+
+    def rest_fallbacks(self) -> Dict[str, int]:
+        cog = self.get_cog("MemberTracking")
+        return dict(cog.fallbacks) if cog else {}
+
+    async def _run_event(self, coro, event_name: str, *args, **kwargs) -> None:
+        if not self.metrics_enabled:
+            return await super()._run_event(coro, event_name, *args, **kwargs)
+        name = getattr(coro, "__qualname__", event_name)
+
+        async def timed(*args, **kwargs):
+            await metrics.timed_listener(coro(*args, **kwargs), name, args)
+
+        await super()._run_event(timed, event_name, *args, **kwargs)
+
+    async def setup_hook(self):
+        self.startup["login"] = time.perf_counter() - self.created
+        with self.phase("services"):
+            await self.start_services()
         # Initialize application commands
         self.log.info("Loading extensions: %s", self.exts)
-        for ext in self.exts:
-            await self.load_extension(ext)
+        with self.phase("extensions"):
+            for ext in self.exts:
+                await self.load_extension(ext)
+        if self.cluster_id == 0:
+            with self.phase("commands"):
+                await self.sync_commands()
+        self.setup_done = time.perf_counter()
+        self.log.info("Bot is setup")
+
+    async def on_ready(self) -> None:
+        if "gateway" in self.startup:
+            # a reconnect, startup was already reported
+            return
+        self.startup["gateway"] = time.perf_counter() - self.setup_done
+        self.log.info(
+            "Ready in %.2fs (%s)",
+            time.perf_counter() - self.created,
+            ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.startup.items()),
+        )
+
+    async def sync_commands(self) -> None:
         # get a unique hash of all commands to prevent duplicate commands
         commands = self.tree.get_commands()
-        raw_hash = pickle.dumps(tuple(command.to_dict() for command in commands))
-        command_hash = base64.b64encode(raw_hash).decode("utf-8")
+        payload = json.dumps(
+            [command.to_dict() for command in commands], sort_keys=True, default=str
+        )
+        command_hash = hashlib.sha256(payload.encode("utf-8")).hexdigest()
         current_hash = await self.redis.get(
             f"command_hash:{self.user.id}:{self.guild.id if self.guild else 0}"
         ) or ""
@@ -79,7 +264,23 @@ class Bot(commands.Bot):
                 command_hash[:5],
             )
 
-        self.log.info("Bot is setup")
+    async def stop_services(self) -> None:
+        """Write out everything still buffered"""
+        for task in self.metrics_tasks:
+            task.cancel()
+        if self.backfill is not None:
+            # the checkpoints let the next start resume where this one stopped
+            self.backfill.cancel()
+        if self.writer is not None:
+            await self.writer.close()
+        if self.invites is not None:
+            await self.invites.close()
+        if self.cache is not None:
+            await self.cache.close()
+
+    async def close(self) -> None:
+        await self.stop_services()
+        await super().close()
 
     async def setup_guild(self, guild: discord.Guild) -> None:
         self.log.info("Setting up guild %s", guild.id)
@@ -89,95 +290,102 @@ class Bot(commands.Bot):
             guild.name 
         except AttributeError:
             guild = await self.fetch_guild(guild.id)
-        async with self.redis.pipeline() as pipe:
-            
-            pipe.hset(f"guild:{guild.id}", mapping={
-                "name": guild.name,
-                "icon": guild.icon.url if guild.icon else "https://cdn.discordapp.com/embed/avatars/0.png",
-                "owner": guild.owner_id,
-                "banner": guild.banner.url if guild.banner else '',
-                "description": guild.description or '',
-                "locale": str(guild.preferred_locale),
-            })
-        
-        stored_roles = await Role.find((Role.guild_id == guild.id)).all()
-        stored_role_ids = [role.id for role in stored_roles]
-        guild_roles = guild.roles
-        for role in guild.roles:
-            if role.id not in stored_role_ids:
-                role = Role(
-                    id=role.id,
-                    guild_id=guild.id,
-                    name=role.name,
-                    color=role.color.value,
-                    position=role.position,
-                    permissions=role.permissions.value,
-                    hoist=role.hoist,
-                    managed=role.managed,
-                    mentionable=role.mentionable,
-                )
-            else:
-                role = stored_roles[stored_role_ids.index(role.id)]
-                for attr in ["name", "color", "position", "permissions", "hoist", "managed", "mentionable"]:
-                    setattr(role, attr, getattr(guild.roles[role.id], attr))
-            
-            await role.save()
-                
-        for role in stored_roles:
-            if role.id not in [role.id for role in guild_roles]:
-                await role.delete(pk=role.pk)
-        
-        
-        # create timeseries for guild if not setup yet
-        if not await self.redis.exists(f"guild:{guild.id}:members"):
-        # member count for the guild
-            await self.redis.ts().create(f"guild:{guild.id}:members", retention_msecs=4838400000, labels={"guild": str(guild.id), "type": "members"}) # 8 weeks
-
-        if not await self.redis.exists(f"guild:{guild.id}:sources"):
-        # the join method
-            await self.redis.ts().create(f"guild:{guild.id}:sources", retention_msecs=4838400000, labels={"guild": str(guild.id), "type": "sources"}) # 8 weeks
-
-        if not await self.redis.exists(f"guild:{guild.id}:sources.leave"):
-            await self.redis.ts().create(f"guild:{guild.id}:sources.leave", retention_msecs=4838400000, labels={"guild": str(guild.id), "type": "sources.leave"}) # 8 weeks
-            
-        if not await self.redis.exists(f"guild:{guild.id}:retention"):
-        # the leave method
-            await self.redis.ts().create(f"guild:{guild.id}:retention", retention_msecs=4838400000, labels={"guild": str(guild.id), "type": "retention"}) # 8 weeks
+        # a no-op for guilds already at the current schema version
+        await self.schema.bootstrap([guild.id])
+
+        details = {
+            "name": guild.name,
+            "icon": guild.icon.url if guild.icon else "https://cdn.discordapp.com/embed/avatars/0.png",
+            "owner": str(guild.owner_id),
+            "banner": guild.banner.url if guild.banner else '',
+            "description": guild.description or '',
+            "locale": str(guild.preferred_locale),
+        }
+        # guild updates and reconnects mostly repeat what's stored already
+        if await self.cached("HGETALL", f"guild:{guild.id}") != details:
+            await self.redis.hset(f"guild:{guild.id}", mapping=details)
+
+        await self.sync_roles(guild)
+
+    @staticmethod
+    def role_values(role: discord.Role) -> dict:
+        return {
+            "name": role.name,
+            "color": role.color.value,
+            "position": role.position,
+            "permissions": role.permissions.value,
+            "hoist": role.hoist,
+            "managed": role.managed,
+            "mentionable": role.mentionable,
+        }
+
+    async def sync_roles(self, guild: discord.Guild) -> int:
+        """Diff the guild's roles against storage and write only the changes"""
+        stored = {
+            role.id: role for role in await Role.find(Role.guild_id == guild.id).all()
+        }
+        current = {role.id: role for role in guild.roles}
+
+        changed = 0
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for role_id, role in current.items():
+                values = self.role_values(role)
+                if (model := stored.get(role_id)) is None:
+                    model = Role(id=role_id, guild_id=guild.id, **values)
+                elif all(getattr(model, k) == v for k, v in values.items()):
+                    continue
+                else:
+                    for attr, value in values.items():
+                        setattr(model, attr, value)
+                await model.save(pipeline=pipe)
+                changed += 1
+
+            for role_id in stored.keys() - current.keys():
+                await Role.delete(stored[role_id].pk, pipeline=pipe)
+                changed += 1
+
+            if changed:
+                await pipe.execute()
+        self.log.debug("Synced %s/%s roles for guild %s", changed, len(current), guild.id)
+        return changed
+
+    async def store_role(self, role: discord.Role) -> None:
+        await Role(id=role.id, guild_id=role.guild.id, **self.role_values(role)).save()
+
+    async def delete_role(self, role: discord.Role) -> None:
+        await Role.delete(role.id)
+
+    async def teardown_guild(self, guild: discord.Guild) -> asyncio.Task:
+        """Forget a guild and remove its keys from a background task"""
+        self.invites.forget(guild.id)
+        self.schema.forget(guild.id)
+        # a running backfill would write documents back after the teardown
+        if (task := self.backfill.tasks.get(guild.id)) is not None:
+            task.cancel()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hdel(GuildSchema.key, guild.id)
+            pipe.zrem(WarmUp.activity_key, guild.id)
+            await pipe.execute()
+        return self.teardown.schedule(guild.id)
 
-        
-    async def teardown_guild(self, guild: discord.Guild) -> None:
-        keys = await self.redis.keys(f"guild:{guild.id}:*")
-        await self.redis.delete(*keys)
-        self.log.info("Tore down guild %s with %s data points", guild.id, len(keys))
-        
     async def store_invites(
         self, guild: discord.Object, invites: List[discord.Invite], *, overwrite=False
     ) -> None:
-        async with self.redis.pipeline(transaction=True) as pipe:
-            if overwrite:
-                pipe.delete(f"guild:{guild.id}:invites")
-            for invite in invites:
-                pipe.hset(
-                    invite.code,
-                    mapping={
-                        "code": invite.code,
-                        "uses": invite.uses,
-                        "max_uses": invite.max_uses,
-                        "guild": invite.guild.id,
-                    },
-                )
-                pipe.sadd(f"guild:{guild.id}:invites", invite.code)
-            await pipe.execute()
+        # hydrate first so only invites that really changed get written back
+        await self.invites.load(guild.id)
+        self.invites.update(guild.id, invites, overwrite=overwrite)
 
     async def delete_invites(
-        self, guild: discord.Object, invites: Optional[List[discord.Invite]]
+        self, guild: discord.Object, invites: Optional[List[discord.Invite]] = None
     ) -> int:
         if invites:
-            keys = [invite.code for invite in invites]
-        else:
-            keys = await self.redis.smembers(f"guild:{guild.id}:invites")
-            await self.redis.delete(f"guild:{guild.id}:invites")
-        return await self.redis.delete(*keys)
+            # hydrated so a deleted invite's last entry is kept for the next diff
+            await self.invites.load(guild.id)
+            return self.invites.discard(guild.id, [invite.code for invite in invites])
+        self.invites.forget(guild.id)
+        keys = await self.redis.smembers(f"guild:{guild.id}:invites")
+        await self.redis.delete(f"guild:{guild.id}:invites")
+        return await self.redis.delete(*keys) if keys else 0
 
     async def get_invites(
         self,
@@ -185,7 +393,14 @@ class Bot(commands.Bot):
         invites: Optional[List[discord.Invite]] = None,
         *,
         data: List[str] = ["code", "uses", "max_uses"],
-    ) -> List[discord.Invite]:
+    ) -> List[dict]:
+        if not invites and set(data) <= set(InviteCache.fields):
+            table = await self.invites.load(guild.id)
+            return [
+                {k: code if k == "code" else getattr(entry, k) for k in data}
+                for code, entry in table.items()
+            ]
+
         if invites:
             keys = [invite.code for invite in invites]
         else:
@@ -200,12 +415,95 @@ class Bot(commands.Bot):
             return [{a: b for (a, b) in zip(data, result)} for result in results]
 
     async def get_invite_codes(self, guild: discord.Object):
-        return await self.redis.smembers(f"guild:{guild.id}:invites")
+        return list(await self.invites.load(guild.id))
+
+    async def join_breakdown(
+        self,
+        guild: discord.Object,
+        *,
+        direction: str = "join",
+        start="-",
+        end="+",
+        by: str = "join_type",
+    ) -> Dict[str, int]:
+        """Count joins (or leaves) per join type, or per linked code with by="code" """
+        reply = await self.redis.execute_command(
+            "TS.MRANGE",
+            start,
+            end,
+            # one bucket wider than any retention, so a range spans at most two
+            "AGGREGATION",
+            "sum",
+            10 * 365 * DAY,
+            "FILTER",
+            f"guild={guild.id}",
+            f"type={by}",
+            f"direction={direction}",
+            "GROUPBY",
+            by,
+            "REDUCE",
+            "sum",
+        )
+        return {
+            group.split("=", 1)[1]: int(sum(float(value) for _, value in samples))
+            for group, _, samples in reply
+        }
+
+    async def top_inviters(
+        self,
+        guild: discord.Object,
+        k: int = 10,
+        *,
+        window: Optional[str] = None,
+        kind: str = "inviters",
+    ) -> List[Tuple[str, int]]:
+        """Top k inviters (or invite codes with kind="codes") for a window"""
+        key = await leaderboard.resolve(
+            self.redis, guild.id, kind, window, int(time.time()) // 86400
+        )
+        return await leaderboard.top(self.redis, key, k)
+
+    async def inviter_rank(
+        self,
+        guild: discord.Object,
+        member: int,
+        *,
+        window: Optional[str] = None,
+        kind: str = "inviters",
+    ) -> Optional[Tuple[int, int]]:
+        key = await leaderboard.resolve(
+            self.redis, guild.id, kind, window, int(time.time()) // 86400
+        )
+        return await leaderboard.rank(self.redis, key, str(member))
+
+    async def retention_curve(
+        self, guild: discord.Object, group: str, *, cohorts: int = 8
+    ) -> Dict[int, List[float]]:
+        """Weekly cohort retention for a join type name, or "code:{code}" """
+        return await retention.curves(
+            self.redis,
+            guild.id,
+            int(time.time()) // retention.WEEK,
+            group=group,
+            cohorts=cohorts,
+        )
+
+    async def retention_histogram(self, guild: discord.Object) -> Dict[str, int]:
+        return await retention.histogram(self.redis, guild.id)
+
+    async def cached(self, command: str, key: str, *args):
+        """Read a rarely changing key through the client-side cache if it's on"""
+        if self.cache is None:
+            return await self.redis.execute_command(command, key, *args)
+        return await self.cache.read(command, key, *args)
 
     async def get_vanity(self, guild: discord.Object, datapoints = ["code", "uses", "max_uses"]):
-        return {a: b for (a,b) in zip(datapoints, await self.redis.hmget(f"guild:{guild.id}:vanity", *datapoints))}
+        return {a: b for (a,b) in zip(datapoints, await self.cached("HMGET", f"guild:{guild.id}:vanity", *datapoints))}
     
-    async def store_vanity(self, guild: discord.Object, invite: discord.Invite):
+    async def store_vanity(self, guild: discord.Object, invite: Optional[discord.Invite]):
+        if invite is None:
+            # vanity url removed, nothing to diff against anymore
+            return await self.delete_vanity(guild)
         await self.redis.hset(f"guild:{guild.id}:vanity", mapping={
             "code": invite.code,
             "uses": invite.uses,
@@ -216,24 +514,33 @@ class Bot(commands.Bot):
     async def delete_vanity(self, guild: discord.Object):
         await self.redis.delete(f"guild:{guild.id}:vanity")
         
-if __name__ == "__main__":
-    if _id := os.getenv("GUILD_ID"):
-        g_id = int(_id)
-    else:
-        g_id = None
-    client_intents = discord.Intents(
+EXTENSIONS = ["cogs.invitetracking", "cogs.admin"]
+# reload extensions on file changes, for development only
+if os.getenv("RELOAD", "").lower() in ("1", "true", "yes"):
+    EXTENSIONS.append("cogs.watcher")
+
+
+def default_intents() -> discord.Intents:
+    return discord.Intents(
         guilds=True,
         members=True,
         integrations=True,
         invites=True,
     )
+
+
+def testing_guild() -> Optional[int]:
+    if _id := os.getenv("GUILD_ID"):
+        return int(_id)
+    return None
+
+
+if __name__ == "__main__":
     client = Bot(
-        intents=client_intents,
-        guild_id=g_id,
-        extensions=["cogs.invitetracking", "cogs.watcher"],
+        intents=default_intents(),
+        guild_id=testing_guild(),
+        extensions=EXTENSIONS,
     )
-    
-    
 
     TOKEN = os.getenv("TOKEN")
     client.run(TOKEN)
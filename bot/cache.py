@@ -0,0 +1,216 @@
+import asyncio
+from logging import getLogger
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+import discord
+import redis.asyncio as redis
+
+
+class CachedInvite(NamedTuple):
+    uses: int
+    max_uses: int
+    inviter: Optional[int]
+    channel: Optional[int] = None
+    created_at: Optional[int] = None
+    expires_at: Optional[int] = None
+    temporary: bool = False
+
+    @classmethod
+    def from_invite(cls, invite: discord.Invite) -> "CachedInvite":
+        return cls(
+            invite.uses or 0,
+            invite.max_uses or 0,
+            invite.inviter.id if invite.inviter else None,
+            invite.channel.id if invite.channel else None,
+            int(invite.created_at.timestamp()) if invite.created_at else None,
+            int(invite.expires_at.timestamp()) if invite.expires_at else None,
+            bool(invite.temporary),
+        )
+
+
+def _int(value) -> Optional[int]:
+    return int(value) if value not in (None, "") else None
+
+
+class InviteCache:
+    """Per-guild invite table kept in memory and written behind to redis
+
+    Redis stays the source of truth across restarts: a guild's table is
+    hydrated the first time it's needed and only invites whose counters
+    changed are written back by ``flush``.
+    """
+
+    fields = [
+        "code",
+        "uses",
+        "max_uses",
+        "inviter",
+        "channel",
+        "created_at",
+        "expires_at",
+        "temporary",
+    ]
+
+    def __init__(self, client: redis.Redis, *, interval: float = 1.0):
+        self.redis = client
+        self.interval = interval
+        self.guilds: Dict[int, Dict[str, CachedInvite]] = {}
+        self.dirty: Dict[int, Set[str]] = {}
+        self.removed: Dict[int, Set[str]] = {}
+        # last known entry of invites deleted since the guild's last snapshot
+        self.tombstones: Dict[int, Dict[str, CachedInvite]] = {}
+        self.writes = 0
+        self.log = getLogger("discord.app").getChild(type(self).__name__)
+        self._task: Optional[asyncio.Task] = None
+
+    async def load(self, guild_id: int) -> Dict[str, CachedInvite]:
+        """Return the invite table of a guild, hydrating it from redis"""
+        if (table := self.guilds.get(guild_id)) is not None:
+            return table
+
+        codes = await self.redis.smembers(f"guild:{guild_id}:invites")
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for code in codes:
+                pipe.hmget(code, *self.fields)
+            rows = await pipe.execute()
+
+        table = {}
+        for code, uses, max_uses, inviter, channel, created, expires, temp in rows:
+            if code is None:
+                continue
+            table[code] = CachedInvite(
+                _int(uses) or 0,
+                _int(max_uses) or 0,
+                _int(inviter),
+                _int(channel),
+                _int(created),
+                _int(expires),
+                temp == "1",
+            )
+        # another coroutine may have hydrated the guild while we waited
+        return self.guilds.setdefault(guild_id, table)
+
+    async def before_image(self, guild_id: int) -> Dict[str, CachedInvite]:
+        """The table as of the last snapshot, invites deleted since included
+
+        Discord deletes an invite on its last use and the delete usually
+        arrives before the joins are diffed, the use is only visible against
+        the entry it had before.
+        """
+        table = await self.load(guild_id)
+        return {**self.tombstones.get(guild_id, {}), **table}
+
+    def update(
+        self, guild_id: int, invites: Iterable[discord.Invite], *, overwrite=False
+    ) -> Dict[str, CachedInvite]:
+        """Apply fresh invites and mark the changed ones for writing
+
+        The table is replaced rather than mutated, so a snapshot returned by
+        ``load`` beforehand remains a consistent before-image. ``overwrite``
+        takes the invites as the full snapshot, ending the tombstones.
+        """
+        old = self.guilds.get(guild_id, {})
+        table = {} if overwrite else dict(old)
+        dirty = self.dirty.setdefault(guild_id, set())
+        removed = self.removed.setdefault(guild_id, set())
+        for invite in invites:
+            entry = CachedInvite.from_invite(invite)
+            if old.get(invite.code) != entry:
+                dirty.add(invite.code)
+            removed.discard(invite.code)
+            table[invite.code] = entry
+
+        if overwrite:
+            for code in old.keys() - table.keys():
+                dirty.discard(code)
+                removed.add(code)
+            self.tombstones.pop(guild_id, None)
+        self.guilds[guild_id] = table
+        return table
+
+    def discard(self, guild_id: int, codes: Iterable[str]) -> int:
+        table = dict(self.guilds.get(guild_id, {}))
+        tombstones = self.tombstones.setdefault(guild_id, {})
+        count = 0
+        for code in codes:
+            if (entry := table.pop(code, None)) is not None:
+                tombstones[code] = entry
+                count += 1
+            self.dirty.get(guild_id, set()).discard(code)
+            self.removed.setdefault(guild_id, set()).add(code)
+        if guild_id in self.guilds:
+            self.guilds[guild_id] = table
+        return count
+
+    def forget(self, guild_id: int) -> None:
+        """Drop a guild from memory without writing anything back"""
+        self.guilds.pop(guild_id, None)
+        self.dirty.pop(guild_id, None)
+        self.removed.pop(guild_id, None)
+        self.tombstones.pop(guild_id, None)
+
+    async def flush(self) -> int:
+        """Write every changed invite to redis in a single pipeline"""
+        dirty, self.dirty = self.dirty, {}
+        removed, self.removed = self.removed, {}
+        count = 0
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for guild_id, codes in dirty.items():
+                table = self.guilds.get(guild_id, {})
+                for code in codes:
+                    if (entry := table.get(code)) is None:
+                        continue
+                    mapping = {
+                        "code": code,
+                        "uses": entry.uses,
+                        "max_uses": entry.max_uses,
+                        "guild": guild_id,
+                        "temporary": int(entry.temporary),
+                    }
+                    for field in ("inviter", "channel", "created_at", "expires_at"):
+                        if (value := getattr(entry, field)) is not None:
+                            mapping[field] = value
+                    pipe.hset(code, mapping=mapping)
+                    pipe.sadd(f"guild:{guild_id}:invites", code)
+                    count += 1
+            for guild_id, codes in removed.items():
+                if codes:
+                    pipe.srem(f"guild:{guild_id}:invites", *codes)
+                    pipe.delete(*codes)
+                    count += len(codes)
+            if count:
+                try:
+                    await pipe.execute()
+                except Exception:
+                    # keep the changes around for the next attempt
+                    for guild_id, codes in dirty.items():
+                        self.dirty.setdefault(guild_id, set()).update(codes)
+                    for guild_id, codes in removed.items():
+                        self.removed.setdefault(guild_id, set()).update(codes)
+                    raise
+        self.writes += count
+        return count
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception("Failed to flush invite cache")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def codes(self, guild_id: int) -> List[str]:
+        return list(self.guilds.get(guild_id, {}))
+
+    def find(self, guild_id: int, code: str) -> Optional[CachedInvite]:
+        return self.guilds.get(guild_id, {}).get(code)
@@ -0,0 +1,252 @@
+"""Run the bot as several processes, each owning a contiguous range of shards
+
+    python cluster.py --processes 4 [--shards 16]
+
+Every process claims its shards in redis before connecting and keeps the
+claim alive while it runs, so two processes never run the same shard and
+count its events twice. Identifies go through a redis lock per rate limit
+bucket, which keeps the whole cluster within Discord's identify limit.
+Per-guild state (invite caches, join batches, buffered writes) lives in the
+process owning the guild's shard, Discord only sends its events there.
+
+The shard count is kept in ``shards:count``. A cluster started with another
+count replaces it once every claim of the old count has expired, until then
+its processes fail to claim and the launcher keeps retrying them.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import time
+from logging import getLogger
+from typing import Dict, List, Optional, Tuple
+
+import discord
+from discord.ext import commands
+
+from bot import EXTENSIONS, Bot, default_intents, testing_guild
+
+log = getLogger("discord.app").getChild("cluster")
+
+# only touch a claim while it's still ours
+RENEW = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class ShardClaimError(RuntimeError):
+    pass
+
+
+class ClusterBot(Bot, commands.AutoShardedBot):
+    # seconds a claim survives a process that stopped renewing it
+    lease = 30
+    # Discord allows one identify per bucket every 5 seconds
+    identify_interval = 5.5
+
+    def __init__(
+        self,
+        *,
+        cluster_id: int,
+        shard_ids: List[int],
+        shard_count: int,
+        max_concurrency: int = 1,
+        **options,
+    ):
+        super().__init__(shard_ids=shard_ids, shard_count=shard_count, **options)
+        self.cluster_id = cluster_id
+        self.max_concurrency = max_concurrency
+        self.instance = f"{socket.gethostname()}:{os.getpid()}"
+        self.log = self.log.getChild(f"cluster{cluster_id}")
+        # set when another process took our shards, the launcher restarts us
+        self.lost_claim = False
+        self._renewer: Optional[asyncio.Task] = None
+
+    def claim_key(self, shard_id: int) -> str:
+        return f"shard:{shard_id}"
+
+    async def start_services(self) -> None:
+        await super().start_services()
+        await self.claim_shards()
+        self._renewer = asyncio.create_task(self.renew_shards())
+
+    async def claim_shards(self) -> None:
+        """Take ownership of every shard of this process or none of them"""
+        # guilds map to shards by the shard count, every process has to agree on it
+        count = await self.redis.set("shards:count", self.shard_count, nx=True, get=True)
+        if count is not None and int(count) != self.shard_count:
+            # processes of the old count may still run, their claims tell
+            if await self.redis.exists(*map(self.claim_key, range(int(count)))):
+                raise ShardClaimError(
+                    f"cluster runs {count} shards, this process was started with "
+                    f"{self.shard_count}, waiting for the old processes to stop"
+                )
+            self.log.info("Shard count changed from %s to %s", count, self.shard_count)
+            await self.redis.set("shards:count", self.shard_count)
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard_id in self.shard_ids:
+                pipe.set(self.claim_key(shard_id), self.instance, nx=True, ex=self.lease)
+            claimed = await pipe.execute()
+        if not all(claimed):
+            taken = [s for s, ok in zip(self.shard_ids, claimed) if not ok]
+            await self.release_shards([s for s, ok in zip(self.shard_ids, claimed) if ok])
+            raise ShardClaimError(f"shards {taken} are owned by another process")
+        self.log.info("Claimed shards %s", self.shard_ids)
+
+    async def renew_shards(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for shard_id in self.shard_ids:
+                    pipe.eval(RENEW, 1, self.claim_key(shard_id), self.instance, self.lease)
+                renewed = await pipe.execute(raise_on_error=False)
+            if not all(r == 1 for r in renewed):
+                # someone else may be running our shards now, stop counting events
+                self.log.error("Lost the claim on shards %s, shutting down", self.shard_ids)
+                self.lost_claim = True
+                asyncio.create_task(self.close())
+                return
+
+    async def release_shards(self, shard_ids: Optional[List[int]] = None) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard_id in self.shard_ids if shard_ids is None else shard_ids:
+                pipe.eval(RELEASE, 1, self.claim_key(shard_id), self.instance)
+            await pipe.execute()
+
+    async def before_identify_hook(self, shard_id: Optional[int], *, initial: bool = False) -> None:
+        # one identify per bucket at a time across every process of the cluster
+        key = f"identify:{(shard_id or 0) % self.max_concurrency}"
+        while not await self.redis.set(
+            key, self.instance, nx=True, px=int(self.identify_interval * 1000)
+        ):
+            await asyncio.sleep(0.5)
+
+    async def close(self) -> None:
+        if self._renewer is not None:
+            self._renewer.cancel()
+        await super().close()
+        if self.redis is not None:
+            await self.release_shards()
+
+
+def shard_ranges(shard_count: int, processes: int) -> List[List[int]]:
+    """Split the shards in contiguous ranges, as even as possible"""
+    size, extra = divmod(shard_count, processes)
+    ranges, start = [], 0
+    for i in range(processes):
+        end = start + size + (i < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+    return [shards for shards in ranges if shards]
+
+
+async def recommended_shards(token: str) -> Tuple[int, int]:
+    """Shard count and identify concurrency Discord recommends for the bot"""
+    # aiohttp comes with discord.py
+    import aiohttp
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            "https://discord.com/api/v10/gateway/bot",
+            headers={"Authorization": f"Bot {token}"},
+        ) as response:
+            response.raise_for_status()
+            data = await response.json()
+    return data["shards"], data["session_start_limit"]["max_concurrency"]
+
+
+def run_process(cluster_id: int, shard_ids: List[int], shard_count: int, max_concurrency: int):
+    bot = ClusterBot(
+        cluster_id=cluster_id,
+        shard_ids=shard_ids,
+        shard_count=shard_count,
+        max_concurrency=max_concurrency,
+        intents=default_intents(),
+        guild_id=testing_guild(),
+        extensions=EXTENSIONS,
+    )
+    bot.run(os.getenv("TOKEN"))
+    if bot.lost_claim:
+        sys.exit(1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the bot as a cluster of processes")
+    parser.add_argument(
+        "--processes", type=int, default=int(os.getenv("CLUSTER_PROCESSES", os.cpu_count() or 1))
+    )
+    parser.add_argument("--shards", type=int, default=int(os.getenv("SHARD_COUNT", "0")))
+    parser.add_argument(
+        "--max-concurrency", type=int, default=int(os.getenv("IDENTIFY_CONCURRENCY", "0"))
+    )
+    args = parser.parse_args()
+    discord.utils.setup_logging()
+
+    shard_count, max_concurrency = args.shards, args.max_concurrency
+    if not shard_count or not max_concurrency:
+        shards, concurrency = asyncio.run(recommended_shards(os.getenv("TOKEN")))
+        shard_count = shard_count or shards
+        max_concurrency = max_concurrency or concurrency
+    ranges = shard_ranges(shard_count, args.processes)
+    log.info("Running %s shards in %s processes: %s", shard_count, len(ranges), ranges)
+
+    processes: Dict[int, multiprocessing.Process] = {}
+
+    def spawn(cluster_id: int) -> None:
+        process = multiprocessing.Process(
+            target=run_process,
+            args=(cluster_id, ranges[cluster_id], shard_count, max_concurrency),
+            name=f"cluster{cluster_id}",
+        )
+        process.start()
+        processes[cluster_id] = process
+
+    # cluster id -> when to start it again
+    restarts: Dict[int, float] = {}
+
+    for cluster_id in range(len(ranges)):
+        spawn(cluster_id)
+    try:
+        while processes or restarts:
+            time.sleep(1)
+            now = time.monotonic()
+            for cluster_id, deadline in list(restarts.items()):
+                if now >= deadline:
+                    del restarts[cluster_id]
+                    spawn(cluster_id)
+            for cluster_id, process in list(processes.items()):
+                if process.is_alive():
+                    continue
+                del processes[cluster_id]
+                if process.exitcode == 0:
+                    continue
+                # a crashed process keeps its claims until the lease runs out
+                log.warning(
+                    "Cluster %s exited with %s, restarting in %ss",
+                    cluster_id,
+                    process.exitcode,
+                    ClusterBot.lease,
+                )
+                restarts[cluster_id] = now + ClusterBot.lease
+    except KeyboardInterrupt:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn")
+    main()
@@ -0,0 +1,224 @@
+import time
+from collections import Counter
+from typing import TYPE_CHECKING, Optional
+
+import discord
+from discord import app_commands
+from discord.ext import commands
+
+import maintenance
+from metrics import metrics, quantile
+from schema import DAY
+from .invitetracking import JOIN_TYPE_NAMES
+
+if TYPE_CHECKING:
+    from ..bot import Bot
+
+
+@app_commands.default_permissions(administrator=True)
+class Admin(commands.GroupCog, group_name="admin"):
+    """Maintenance commands for the bot owners"""
+
+    def __init__(self, bot):
+        self.bot: "Bot" = bot
+        self.log = bot.log.getChild("Admin")
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if await self.bot.is_owner(interaction.user):
+            return True
+        await interaction.response.send_message(
+            ":warning: Only the bot owners can run maintenance commands",
+            ephemeral=True,
+        )
+        return False
+
+    @app_commands.command(name="member-index")
+    async def member_index(self, interaction: discord.Interaction) -> None:
+        """Build the member lookup mapping for existing Member documents"""
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        start = time.perf_counter()
+        count = await maintenance.backfill_member_index(self.bot.bulk)
+        self.log.info("Indexed %s members", count)
+        await interaction.followup.send(
+            f"Indexed {count} members in {time.perf_counter() - start:.2f}s",
+            ephemeral=True,
+        )
+
+    @app_commands.command()
+    @app_commands.describe(
+        raw_days="Shorten the raw series to this many days once the rollups are filled"
+    )
+    async def rollups(
+        self, interaction: discord.Interaction, raw_days: Optional[int] = None
+    ) -> None:
+        """Compute rollups from existing raw samples for every guild"""
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        start = time.perf_counter()
+        retention = raw_days * DAY if raw_days else 0
+        count = 0
+        for guild in self.bot.guilds:
+            count += await maintenance.backfill_rollups(
+                self.bot.bulk, guild.id, raw_retention=retention
+            )
+        self.log.info("Backfilled %s rollup buckets", count)
+        await interaction.followup.send(
+            f"Backfilled {count} rollup buckets for {len(self.bot.guilds)} guilds "
+            f"in {time.perf_counter() - start:.2f}s",
+            ephemeral=True,
+        )
+
+    @app_commands.command(name="join-types")
+    async def join_types(self, interaction: discord.Interaction) -> None:
+        """Derive the per-join-type counter series from existing sources data"""
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        start = time.perf_counter()
+        count = 0
+        for guild in self.bot.guilds:
+            count += await maintenance.derive_join_type_series(
+                self.bot.bulk, guild.id, JOIN_TYPE_NAMES
+            )
+        self.log.info("Derived %s join type samples", count)
+        await interaction.followup.send(
+            f"Derived {count} samples for {len(self.bot.guilds)} guilds "
+            f"in {time.perf_counter() - start:.2f}s",
+            ephemeral=True,
+        )
+
+    @app_commands.command(name="leaderboards")
+    async def leaderboards(self, interaction: discord.Interaction) -> None:
+        """Move the old per-inviter counters into the leaderboard sorted sets"""
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        start = time.perf_counter()
+        count = await maintenance.migrate_inviter_counters(self.bot.bulk)
+        self.log.info("Migrated %s inviter counters", count)
+        await interaction.followup.send(
+            f"Migrated {count} inviter counters in {time.perf_counter() - start:.2f}s",
+            ephemeral=True,
+        )
+
+    @app_commands.command()
+    @app_commands.describe(guild_id="Only rebuild this guild, and show what changed")
+    async def stats(
+        self, interaction: discord.Interaction, guild_id: Optional[str] = None
+    ) -> None:
+        """Recompute the dashboard stats documents from history"""
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        start = time.perf_counter()
+        ids = [int(guild_id)] if guild_id else [guild.id for guild in self.bot.guilds]
+        drifted = {}
+        for i in ids:
+            result = await maintenance.rebuild_stats(self.bot.bulk, i)
+            previous, rebuilt = result["previous"], result["rebuilt"]
+            drifted[i] = sorted(
+                field
+                for field in set(previous) | set(rebuilt)
+                if field != "updated" and previous.get(field) != rebuilt.get(field)
+            )
+        message = (
+            f"Rebuilt {len(ids)} stats documents in {time.perf_counter() - start:.2f}s, "
+            f"{sum(1 for fields in drifted.values() if fields)} had drifted"
+        )
+        if guild_id:
+            previous, rebuilt = result["previous"], result["rebuilt"]
+            message += "".join(
+                f"\n`{field}`: {previous.get(field)} -> {rebuilt.get(field)}"
+                for field in drifted[int(guild_id)][:20]
+            )
+        self.log.info(message)
+        await interaction.followup.send(message, ephemeral=True)
+
+    @app_commands.command()
+    @app_commands.describe(
+        guild_id="Only backfill this guild",
+        restart="Forget the checkpoint and start over",
+    )
+    async def backfill(
+        self,
+        interaction: discord.Interaction,
+        guild_id: Optional[str] = None,
+        restart: bool = False,
+    ) -> None:
+        """Write Member documents for members who joined before the bot tracked them"""
+        guilds = (
+            [self.bot.get_guild(int(guild_id))] if guild_id else list(self.bot.guilds)
+        )
+        guilds = [guild for guild in guilds if guild is not None]
+        if restart and guilds:
+            await self.bot.redis.delete(
+                *(self.bot.backfill.checkpoint_key(guild.id) for guild in guilds)
+            )
+        for guild in guilds:
+            self.bot.backfill.schedule(guild)
+
+        lines = [f"Backfilling {len(guilds)} guilds in the background"]
+        if guild_id and guilds:
+            state = await self.bot.backfill.status(guilds[0].id)
+            if state:
+                lines.append(
+                    f"Checkpoint: {state.get('seen', 0)} seen, {state.get('written', 0)} written"
+                    + (", done" if state.get("done") else "")
+                )
+        await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+    @app_commands.command(name="metrics")
+    async def show_metrics(self, interaction: discord.Interaction) -> None:
+        """Show where the event loop time goes"""
+        if not self.bot.metrics_enabled:
+            await interaction.response.send_message(
+                "Metrics are off, start the bot with METRICS=1", ephemeral=True
+            )
+            return
+        commands = metrics.counters.get("redis_commands_total", {})
+        listeners = sorted(
+            metrics.histograms.get("listener_seconds", {}).items(),
+            key=lambda item: item[1].sum,
+            reverse=True,
+        )
+        lines = ["**Listeners** (calls, total, p50, p99, redis commands/call)"]
+        for labels, histogram in listeners[:8]:
+            name = dict(labels)["listener"]
+            lines.append(
+                f"`{name}` {histogram.count}, {histogram.sum:.2f}s, "
+                f"<{histogram.quantile(0.5) * 1000:g}ms, <{histogram.quantile(0.99) * 1000:g}ms, "
+                f"{commands.get(labels, 0) / histogram.count:.1f}"
+            )
+        routes = metrics.counters.get("rest_requests_total", Counter())
+        lines.append("**REST** (requests)")
+        for labels, count in routes.most_common(5):
+            labels = dict(labels)
+            lines.append(f"`{labels['method']} {labels['route']}` {count} {labels['status']}")
+        limits = metrics.counters.get("rest_ratelimit_seconds_total", Counter())
+        lines.append(f"Rate limited for {sum(limits.values()):.2f}s")
+        lines.append(
+            "REST fallbacks "
+            + (", ".join(f"{site} {count}" for site, count in self.bot.rest_fallbacks().items()) or "none")
+        )
+        lines.append(
+            "**Queues** "
+            + ", ".join(f"{name} {read()}" for name, read in metrics.gauges.items())
+        )
+        writer = self.bot.writer
+        lines.append(
+            f"**Writer** {writer.flushes} flushes, batch p50 "
+            f"{quantile(writer.batch_sizes, 0.5):g} max {max(writer.batch_sizes, default=0)}, "
+            f"flush p50 {quantile(writer.flush_times, 0.5) * 1000:.2f}ms "
+            f"p99 {quantile(writer.flush_times, 0.99) * 1000:.2f}ms"
+        )
+        if lag := metrics.histograms.get("event_loop_lag_seconds", {}).get(()):
+            lines.append(f"Event loop lag p99 <{lag.quantile(0.99) * 1000:g}ms")
+        lines.append(
+            f"Autocomplete p50 {self.bot.autocomplete_percentile(0.5) * 1000:.2f}ms, "
+            f"p99 {self.bot.autocomplete_percentile(0.99) * 1000:.2f}ms"
+        )
+        lines.append(
+            "**Busiest guilds** "
+            + ", ".join(
+                f"{guild_id} {seconds:.2f}s"
+                for guild_id, seconds in metrics.guild_time.most_common(5)
+            )
+        )
+        await interaction.response.send_message("\n".join(lines)[:2000], ephemeral=True)
+
+
+async def setup(bot: commands.Bot) -> None:
+    await bot.add_cog(Admin(bot))
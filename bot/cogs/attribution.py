@@ -0,0 +1,49 @@
+from typing import Dict, List, Mapping, NamedTuple, Optional
+
+
+class InviteUses(NamedTuple):
+    """The fields attribution needs, ``cache.CachedInvite`` has them too"""
+
+    uses: int
+    max_uses: int
+
+
+def diff_invites(
+    old: Mapping[str, InviteUses], new: Mapping[str, InviteUses]
+) -> Dict[str, int]:
+    """Return the use count delta of every invite that was used
+
+    Invites that disappeared are counted as used once when they were one use
+    away from their ``max_uses``, since Discord deletes them on the last use.
+    """
+    deltas = {}
+    for code, invite in new.items():
+        previous = old.get(code)
+        delta = invite.uses - (previous.uses if previous else 0)
+        if delta > 0:
+            deltas[code] = delta
+    for code, invite in old.items():
+        if code not in new and invite.max_uses and invite.uses == invite.max_uses - 1:
+            deltas[code] = 1
+    return deltas
+
+
+def assign_joins(deltas: Mapping[str, int], joins: int) -> List[Optional[str]]:
+    """Distribute ``joins`` pending members over the used invites
+
+    Returns one entry per join: the invite code it is attributed to, ``None``
+    when no invite accounts for it (discovery or vanity) or ``""`` when the
+    deltas are ambiguous. Codes with the largest delta are assigned first so
+    the result is deterministic.
+    """
+    total = sum(deltas.values())
+    if total > joins and len(deltas) > 1:
+        # more uses than joins spread over several codes, can't tell which
+        return [""] * joins
+
+    assigned: List[Optional[str]] = []
+    for code in sorted(deltas, key=lambda c: (-deltas[c], c)):
+        assigned.extend([code] * deltas[code])
+    assigned = assigned[:joins]
+    assigned.extend([None] * (joins - len(assigned)))
+    return assigned
@@ -0,0 +1,122 @@
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+
+def trigrams(term: str) -> Set[str]:
+    return {term[i : i + 3] for i in range(len(term) - 2)}
+
+
+class InviteIndex:
+    """Prefix and trigram index over a guild's invite codes and linked names"""
+
+    def __init__(self):
+        self.names: Dict[str, Optional[str]] = {}
+        # (lowercased term, code) for every code and name, kept sorted
+        self.terms: List[Tuple[str, str]] = []
+        self.grams: Dict[str, Set[str]] = {}
+
+    def _terms(self, code: str) -> List[str]:
+        terms = [code.lower()]
+        if name := self.names.get(code):
+            terms.append(name.lower())
+        return terms
+
+    def add(self, code: str, name: Optional[str] = None) -> None:
+        if code in self.names:
+            self.remove(code)
+        self.names[code] = name
+        for term in self._terms(code):
+            insort(self.terms, (term, code))
+            for gram in trigrams(term):
+                self.grams.setdefault(gram, set()).add(code)
+
+    def remove(self, code: str) -> None:
+        if code not in self.names:
+            return
+        for term in self._terms(code):
+            i = bisect_left(self.terms, (term, code))
+            if i < len(self.terms) and self.terms[i] == (term, code):
+                del self.terms[i]
+            for gram in trigrams(term):
+                if (codes := self.grams.get(gram)) is not None:
+                    codes.discard(code)
+                    if not codes:
+                        del self.grams[gram]
+        del self.names[code]
+
+    def search(self, query: str, limit: int = 5) -> List[str]:
+        query = query.lower()
+        found: Dict[str, None] = {}
+        if not query:
+            for code in self.names:
+                if len(found) >= limit:
+                    break
+                found[code] = None
+            return list(found)
+
+        # prefix matches first, they're what someone typing a code expects
+        i = bisect_left(self.terms, (query, ""))
+        while i < len(self.terms) and len(found) < limit:
+            term, code = self.terms[i]
+            if not term.startswith(query):
+                break
+            found.setdefault(code, None)
+            i += 1
+
+        if len(found) < limit and len(query) >= 3:
+            scores: Dict[str, int] = {}
+            for gram in trigrams(query):
+                for code in self.grams.get(gram, ()):
+                    scores[code] = scores.get(code, 0) + 1
+            for code in sorted(scores, key=lambda c: (-scores[c], c)):
+                if len(found) >= limit:
+                    break
+                found.setdefault(code, None)
+        return list(found)
+
+
+class AutocompleteCache:
+    """LRU of per-guild invite indexes shared by the autocomplete handlers"""
+
+    def __init__(
+        self,
+        build: Callable[[int], Awaitable[Dict[str, Optional[str]]]],
+        *,
+        capacity: int = 256,
+    ):
+        self.build = build
+        self.capacity = capacity
+        self.indexes: "OrderedDict[int, InviteIndex]" = OrderedDict()
+        self.latencies: Deque[float] = deque(maxlen=1000)
+
+    async def get(self, guild_id: int) -> InviteIndex:
+        if (index := self.indexes.get(guild_id)) is not None:
+            self.indexes.move_to_end(guild_id)
+            return index
+
+        index = InviteIndex()
+        for code, name in (await self.build(guild_id)).items():
+            index.add(code, name)
+        self.indexes[guild_id] = index
+        while len(self.indexes) > self.capacity:
+            self.indexes.popitem(last=False)
+        return index
+
+    def peek(self, guild_id: int) -> Optional[InviteIndex]:
+        """Return an index only if it's already built, for event updates"""
+        return self.indexes.get(guild_id)
+
+    async def search(self, guild_id: int, query: str, limit: int = 5) -> List[str]:
+        start = time.perf_counter()
+        try:
+            return (await self.get(guild_id)).search(query, limit)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
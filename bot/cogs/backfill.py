@@ -0,0 +1,120 @@
+import asyncio
+import time
+from logging import Logger
+from typing import Dict, List, Optional
+
+import discord
+import redis.asyncio as redis
+
+from .utils import member_document
+from .warmup import RateLimiter
+
+
+class MemberBackfill:
+    """Write Member documents for everyone who joined while the bot was offline
+
+    Members are streamed from ``guild.fetch_members`` in ascending id order
+    and written ``chunk`` at a time, so memory stays bounded by one chunk per
+    running guild. The last id written goes to ``backfill:{guild}`` with the
+    chunk, a restart picks up right after it. ``concurrency`` guilds run at
+    once, sharing a chunk rate limit so the live handlers keep their share of
+    redis and the gateway.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        *,
+        log: Logger,
+        join_type: str = "NotTracked",
+        chunk: int = 1000,
+        concurrency: int = 4,
+        rate: float = 20,
+    ):
+        self.redis = client
+        self.log = log
+        self.join_type = join_type
+        self.chunk = chunk
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = RateLimiter(rate)
+        self.tasks: Dict[int, asyncio.Task] = {}
+
+    @staticmethod
+    def checkpoint_key(guild_id: int) -> str:
+        return f"backfill:{guild_id}"
+
+    def schedule(self, guild: discord.Guild) -> asyncio.Task:
+        if (task := self.tasks.get(guild.id)) is None or task.done():
+            task = asyncio.create_task(self.run(guild))
+            self.tasks[guild.id] = task
+            task.add_done_callback(lambda _: self.tasks.pop(guild.id, None))
+        return task
+
+    async def status(self, guild_id: int) -> Dict[str, str]:
+        return await self.redis.hgetall(self.checkpoint_key(guild_id))
+
+    async def _write(self, guild: discord.Guild, members: List[discord.Member]) -> int:
+        pks_key = f"guild:{guild.id}:member_pks"
+        known = await self.redis.hmget(pks_key, [m.id for m in members])
+        # members tracked live keep their real join type
+        missing = [
+            m for m, pk in zip(members, known) if pk is None and m.joined_at and not m.bot
+        ]
+        checkpoint = self.checkpoint_key(guild.id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if missing:
+                pks = {}
+                for member in missing:
+                    document = member_document(member, self.join_type)
+                    # already JSON, json().set would store it as one string
+                    pipe.execute_command("JSON.SET", document.key(), "$", document.json())
+                    pks[member.id] = document.pk
+                pipe.hset(pks_key, mapping=pks)
+                pipe.sadd(f"guild:{guild.id}:joins", *pks)
+            pipe.hset(checkpoint, "after", members[-1].id)
+            pipe.hincrby(checkpoint, "seen", len(members))
+            pipe.hincrby(checkpoint, "written", len(missing))
+            await pipe.execute()
+        return len(missing)
+
+    async def run(self, guild: discord.Guild) -> int:
+        checkpoint = self.checkpoint_key(guild.id)
+        async with self.semaphore:
+            state = await self.redis.hgetall(checkpoint)
+            if state.get("done"):
+                return 0
+            after: Optional[discord.Object] = (
+                discord.Object(int(state["after"])) if state.get("after") else None
+            )
+            if after:
+                self.log.info("Resuming backfill of guild %s after %s", guild.id, after.id)
+            start = time.perf_counter()
+            seen = written = 0
+            members: List[discord.Member] = []
+            async for member in guild.fetch_members(limit=None, after=after):
+                members.append(member)
+                if len(members) >= self.chunk:
+                    await self.limiter.acquire()
+                    written += await self._write(guild, members)
+                    seen += len(members)
+                    members = []
+            if members:
+                written += await self._write(guild, members)
+                seen += len(members)
+            await self.redis.hset(checkpoint, "done", int(time.time()))
+
+        elapsed = time.perf_counter() - start
+        self.log.info(
+            "Backfilled %s/%s members of guild %s in %.2fs (%.0f members/s)",
+            written,
+            seen,
+            guild.id,
+            elapsed,
+            seen / elapsed if elapsed else 0,
+        )
+        return written
+
+    def cancel(self) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
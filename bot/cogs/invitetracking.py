@@ -1,17 +1,23 @@
+import os
+import time
+from collections import Counter
 from datetime import datetime
 from enum import Enum
-from typing import TYPE_CHECKING, List, Optional
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 from discord.ext.commands import Cog
 from models import Member
-from aredis_om.model import model
-from .utils import compareInvites, dump_invite
-from fuzzywuzzy import process
-from tqdm.contrib.logging import tqdm_logging_redirect
-from tqdm import tqdm
+import scripts
+from schema import RETENTION
+import leaderboard
+import retention
+from .autocomplete import AutocompleteCache
+from .attribution import assign_joins, diff_invites
+from .utils import JoinCoalescer, dump_invite, member_document
+from .warmup import WarmUp
 
 if TYPE_CHECKING:
     from redis.asyncio.client import Pipeline
@@ -28,30 +34,100 @@ class JoinType(Enum):
     Vanity = 5
 
 
+# position matches the value stored in the sources series
+JOIN_TYPE_NAMES = [t.name for t in sorted(JoinType, key=lambda t: t.value)]
+
+
+class JoinResult(NamedTuple):
+    join_type: JoinType
+    code: Optional[str] = None
+    inviter: Optional[int] = None
+
+
 class MemberTracking(Cog):
     def __init__(self, bot):
         self.bot: "Bot" = bot
         self.log = bot.log.getChild("MemberTracking")
+        self.autocomplete = AutocompleteCache(
+            self._invite_names,
+            capacity=int(os.getenv("AUTOCOMPLETE_GUILDS", "256")),
+        )
+        # how often REST had to be used because an invite wasn't stored
+        self.fallbacks: Counter = Counter()
+        self.joins = JoinCoalescer(
+            self._attribute_joins,
+            window=float(os.getenv("JOIN_BATCH_WINDOW", "0.5")),
+        )
+
+    async def cog_unload(self):
+        self.joins.cancel()
+
+    def export_state(self) -> dict:
+        """In-memory state handed to the next instance on a reload"""
+        return {"indexes": self.autocomplete.indexes, "fallbacks": self.fallbacks}
+
+    def import_state(self, state: dict) -> None:
+        self.autocomplete.indexes = state["indexes"]
+        self.fallbacks = state["fallbacks"]
 
     @app_commands.command()
     async def dashboard(self, interaction: discord.Interaction) -> None:
         """Configure the bot's settings"""
         await interaction.respond("https://itracker.squid.pink/")
 
+    @app_commands.command()
+    @app_commands.guild_only()
+    @app_commands.choices(
+        window=[
+            app_commands.Choice(name="All time", value="all"),
+            app_commands.Choice(name="Last 7 days", value="7d"),
+            app_commands.Choice(name="Last 30 days", value="30d"),
+        ]
+    )
+    async def leaderboard(
+        self,
+        interaction: discord.Interaction,
+        window: str = "all",
+        member: Optional[discord.Member] = None,
+    ) -> None:
+        """Show the top inviters of this server"""
+        window = None if window == "all" else window
+        top = await self.bot.top_inviters(interaction.guild, 10, window=window)
+        lines = [
+            f"**{i}.** <@{inviter}> - {count} invite{'s' if count != 1 else ''}"
+            for i, (inviter, count) in enumerate(top, start=1)
+        ]
+        user = member or interaction.user
+        if rank := await self.bot.inviter_rank(interaction.guild, user.id, window=window):
+            lines.append(f"\n{user.mention} is **#{rank[0]}** with {rank[1]} invites")
+        embed = discord.Embed(
+            title="Top inviters",
+            description="\n".join(lines) or "No invites tracked yet",
+        )
+        await interaction.response.send_message(
+            embed=embed, allowed_mentions=discord.AllowedMentions.none()
+        )
+
+    async def _invite_names(self, guild_id: int) -> Dict[str, Optional[str]]:
+        codes = await self.bot.get_invite_codes(discord.Object(id=guild_id))
+        async with self.bot.redis.pipeline(transaction=False) as pipe:
+            for code in codes:
+                pipe.hget(code, "name")
+            names = await pipe.execute()
+        return dict(zip(codes, names))
+
     async def invite_auto_complete(
         self, interaction: discord.Interaction, current: str
     ) -> List[app_commands.Choice[str]]:
-        guild_invites: List[str] = await self.bot.get_invite_codes(interaction.guild)
-
-        if len(current) > 0:
-            closest = process.extract(current, guild_invites, limit=5)
-        else:
-            closest = [(invite, 100) for invite in guild_invites[:5]]
-
-        return [
-            app_commands.Choice(name=f".gg/{invite}", value=f"discord.gg/{invite}")
-            for invite, _ in closest
-        ]
+        closest = await self.autocomplete.search(interaction.guild_id, current)
+        index = self.autocomplete.peek(interaction.guild_id)
+        choices = []
+        for invite in closest:
+            label = f".gg/{invite}"
+            if index and (name := index.names.get(invite)):
+                label += f" ({name})"
+            choices.append(app_commands.Choice(name=label, value=f"discord.gg/{invite}"))
+        return choices
 
     @app_commands.command()
     @app_commands.default_permissions(manage_guild=True)
@@ -112,46 +188,64 @@ class MemberTracking(Cog):
         ):
             # refetching invites
             invites = await interaction.guild.invites()
-            await self.bot.store_invites(invites=invites, overwrite=True)
+            await self.bot.store_invites(interaction.guild, invites, overwrite=True)
             await self.bot.setup_guild(interaction.guild)
 
         def clean(s):
             protected_words = ["discovery", "vanity", "unknown", "discord", "invite"]
             if s in protected_words:
                 return "user:" + s
+            return s
 
+        name = clean(name or role.name)
         await self.bot.redis.hset(
             actual_invite.code,
             mapping={
                 "role": role.id,
-                "name": clean(name or role.name),
+                "name": name,
             },
         )
+        if index := self.autocomplete.peek(interaction.guild.id):
+            index.add(actual_invite.code, name)
 
     @Cog.listener()
     async def on_ready(self):
-        with tqdm_logging_redirect(self.log):
-            for guild in tqdm(self.bot.guilds):
-                # check for existing redis issue
-                phrase = "discord.Forbidden: discord permissions error to fetch invites for guild"
-                if await self.bot.redis.sismember(f"guild:{guild.id}:errors", phrase):
-                    self.log.debug(
-                        "Ignoring guild %s due to previous error", guild.name
-                    )
-                    continue
-
-                try:
-                    invites = await guild.invites()
-                except discord.Forbidden:
-                    self.log.debug(
-                        "discord permissions error to fetch invites for guild %s (%s)",
-                        guild.name,
-                        guild.id,
-                    )
-                    await self.bot.redis.sadd(f"guild:{guild.id}:errors", phrase)
-                else:
-                    await self.bot.store_invites(guild, invites, overwrite=True)
-                    await self.bot.setup_guild(guild)
+        warmup = WarmUp(
+            self.bot.bulk,
+            self.warm_guild,
+            # only a reconnect of this process may skip guilds, a restart has
+            # no invite tables to diff against yet
+            done_key=f"warmup:{self.bot.user.id}:{self.bot.session}",
+            log=self.log,
+            concurrency=int(os.getenv("WARMUP_CONCURRENCY", "8")),
+            rate=float(os.getenv("WARMUP_RATE", "25")),
+            ttl=int(os.getenv("WARMUP_TTL", "10")) * 60,
+        )
+        # one round trip when every guild is already at the current schema
+        await self.bot.schema.bootstrap(guild.id for guild in self.bot.guilds)
+        await warmup.run(self.bot.guilds)
+
+    async def warm_guild(self, guild: discord.Guild) -> bool:
+        """Snapshot a guild's invites and set it up, returns False if skipped"""
+        # check for existing redis issue
+        phrase = "discord.Forbidden: discord permissions error to fetch invites for guild"
+        if await self.bot.cached("SISMEMBER", f"guild:{guild.id}:errors", phrase):
+            self.log.debug("Ignoring guild %s due to previous error", guild.name)
+            return False
+
+        try:
+            invites = await guild.invites()
+        except discord.Forbidden:
+            self.log.debug(
+                "discord permissions error to fetch invites for guild %s (%s)",
+                guild.name,
+                guild.id,
+            )
+            await self.bot.redis.sadd(f"guild:{guild.id}:errors", phrase)
+            return False
+        await self.bot.store_invites(guild, invites, overwrite=True)
+        await self.bot.setup_guild(guild)
+        return True
 
     @Cog.listener()
     async def on_guild_join(self, guild: discord.Guild) -> None:
@@ -174,33 +268,45 @@ class MemberTracking(Cog):
     async def on_guild_remove(self, guild: discord.Guild) -> None:
         """Remove a guild from the database when leaving"""
         await self.bot.teardown_guild(guild)
-        await self.bot.delete_invites(guild)
+
+    @Cog.listener()
+    async def on_guild_role_create(self, role: discord.Role) -> None:
+        await self.bot.store_role(role)
+
+    @Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role) -> None:
+        if self.bot.role_values(before) != self.bot.role_values(after):
+            await self.bot.store_role(after)
+
+    @Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role) -> None:
+        await self.bot.delete_role(role)
 
     @Cog.listener()
     async def on_invite_create(self, invite: discord.Invite) -> None:
         """Add an invite to the database once it's created"""
-        if not hasattr(invite.guild, "name"):
+        if invite.guild is None:
+            self.fallbacks["on_invite_create"] += 1
             invite = await self.bot.fetch_invite(invite.url)
+        # a partial guild is fine, only the id is stored
         await self.bot.store_invites(invite.guild, [invite])
+        if index := self.autocomplete.peek(invite.guild.id):
+            index.add(invite.code)
 
     @Cog.listener()
     async def on_invite_delete(self, invite: discord.Invite):
         """Purge Invite from database when deleted"""
-        if not hasattr(invite.guild, "name"):
+        if invite.guild is None:
+            self.fallbacks["on_invite_delete"] += 1
             invite = await self.bot.fetch_invite(invite.url)
         await self.bot.delete_invites(invite.guild, [invite])
+        if index := self.autocomplete.peek(invite.guild.id):
+            index.remove(invite.code)
 
-    @Cog.listener()
-    async def on_member_join(self, member: discord.Member) -> None:
-        """Check if a member joined with an invite"""
-        if member.bot:
-            return
-
-        if not hasattr(member.guild, "name"):
-            guild: discord.Guild = await self.bot.fetch_guild(member.guild.id)
-        else:
-            guild: discord.Guild = member.guild
-
+    async def _attribute_joins(
+        self, guild: discord.Guild, members: List[discord.Member]
+    ) -> Optional[List[JoinResult]]:
+        """Attribute a batch of joins from a single invite snapshot"""
         try:
             invites_raw = await guild.invites()
         except discord.Forbidden:
@@ -215,163 +321,170 @@ class MemberTracking(Cog):
                 f"guild:{guild.id}:errors",
                 "discord.Forbidden: discord permissions error to fetch invites for guild",
             )
-            return
-        datapoints = ["code", "uses", "max_uses"]
-        old_invites = await self.bot.get_invites(member.guild, data=datapoints)
-        await self.bot.store_invites(member.guild, invites_raw, overwrite=True)
-        invites = [
-            {k: getattr(invite, k) for k in datapoints} for invite in invites_raw
-        ]
-
-        join_type: JoinType = JoinType.Unknown
-        invite = None
-
-        def eq(a, b):
-            if len(a) != len(b):
-                return False
-            x = sorted(a, key=lambda z: z["code"])
-            y = sorted(b, key=lambda z: z["code"])
-            for i, j in zip(x, y):
-                if i["code"] != j["code"] or int(i["uses"]) != int(j["uses"]):
-                    return False
-            return True
+            return None
+        # warm-up order on the next start follows recent join activity
+        await self.bot.redis.zadd(WarmUp.activity_key, {guild.id: time.time()})
+        # the cached table is replaced, not mutated, so it stays the before-image
+        old_invites = await self.bot.invites.before_image(guild.id)
+        await self.bot.store_invites(guild, invites_raw, overwrite=True)
+
+        deltas = diff_invites(old_invites, self.bot.invites.guilds[guild.id])
+        self.log.debug("Invite deltas: %s", deltas)
+
+        results: List[JoinResult] = []
+        for code in assign_joins(deltas, len(members)):
+            if code is None:
+                results.append(JoinResult(JoinType.Discovery))
+            elif code:
+                results.append(JoinResult(JoinType.Invite, code))
+            else:
+                results.append(JoinResult(JoinType.Unknown))
 
-        if "VANITY_URL" in member.guild.features and eq(invites, old_invites):
+        discovered = [i for i, r in enumerate(results) if r.join_type == JoinType.Discovery]
+        if discovered and "VANITY_URL" in guild.features:
             self.log.info("Potential vanity invite detected")
-            vanity: Optional[discord.Invite] = await guild.vanity_invite()
-            old_vanity = await self.bot.get_vanity(guild)
-            await self.bot.store_vanity(guild, vanity)
-            print("o: ", old_vanity['uses'], "n:", vanity.uses)
-            if old_vanity and vanity:
-                if int(old_vanity["uses"]) + 1 == vanity.uses:
-                    join_type = JoinType.Vanity
-                    invite = vanity
+            # the joins stay discovery joins if the vanity can't be checked
+            try:
+                vanity: Optional[discord.Invite] = await guild.vanity_invite()
+            except discord.HTTPException as e:
+                self.log.debug("Couldn't fetch the vanity invite of %s: %s", guild.id, e)
+            else:
+                old_vanity = await self.bot.get_vanity(guild)
+                if vanity is None:
+                    # the guild lost its vanity url
+                    await self.bot.delete_vanity(guild)
                 else:
-                    join_type = JoinType.Discovery
+                    await self.bot.store_vanity(guild, vanity)
+                    # a changed vanity url restarts its uses, nothing to diff against
+                    if old_vanity.get("code") == vanity.code and old_vanity.get("uses") is not None:
+                        vanity_joins = max(0, vanity.uses - int(old_vanity["uses"]))
+                        for i in discovered[:vanity_joins]:
+                            results[i] = JoinResult(JoinType.Vanity, vanity.code)
+
+        inviters = {}
+        for i, result in enumerate(results):
+            if result.join_type != JoinType.Invite:
+                continue
+            if (code := result.code) not in inviters:
+                # invites used up on this join are only left in the old table
+                cached = self.bot.invites.find(guild.id, code) or old_invites.get(code)
+                if cached is not None and cached.inviter is not None:
+                    inviters[code] = cached.inviter
+                else:
+                    inviters[code] = await self._fetch_inviter(code)
+            results[i] = result._replace(inviter=inviters[code])
+        return results
+
+    async def _fetch_inviter(self, code: str) -> Optional[int]:
+        """Resolve an inviter over REST when the invite isn't stored"""
+        self.fallbacks["fetch_invite"] += 1
+        self.log.debug("Invite %s missing from the store, fetching it", code)
+        try:
+            invite = await self.bot.fetch_invite(f"discord.gg/{code}")
+        except discord.HTTPException as e:
+            # one unresolvable inviter mustn't fail the rest of the batch
+            self.log.debug("Couldn't fetch invite %s: %s", code, e)
+            return None
+        return invite.inviter.id if invite.inviter else None
 
-        if join_type == JoinType.Unknown:
-            used_invites = compareInvites(old_invites, invites)
-            self.log.debug("Used invites: %s", used_invites)
+    @Cog.listener()
+    async def on_member_join(self, member: discord.Member) -> None:
+        """Check if a member joined with an invite"""
+        if member.bot:
+            return
 
-            if len(used_invites) == 0:
-                join_type = JoinType.Discovery
-            elif len(used_invites) == 1:
-                join_type = JoinType.Invite
-                invite = used_invites[0]
-            else:
-                join_type = JoinType.Unknown
+        if not hasattr(member.guild, "name"):
+            guild: discord.Guild = await self.bot.fetch_guild(member.guild.id)
+        else:
+            guild: discord.Guild = member.guild
 
-            if invite:
-                try:
-                    invite = await self.bot.fetch_invite(f"discord.gg/{invite}")
-                except discord.NotFound:
-                    invite = None
+        result = await self.joins.submit(guild, member)
+        if result is None:
+            return
+        join_type, code, inviter = result
 
         self.log.info(
             f"{member.name} joined with {join_type} [Invite: %s]",
-            invite.code if invite else "N/A",
+            code or "N/A",
         )
 
         if not (m_count := member.guild.member_count):
-            m_count = await self.bot.redis.ts().get(f"guild:{guild.id}:members")
-            if m_count is None and invite is not None:
-                m_count = invite.approximate_member_count
-            else:
-                m_count = 0
-            m_count += 1
-
-        ts = int(member.joined_at.timestamp() * 1000)
-        print(ts)
-        print(
-            await self.bot.redis.ts().madd(
-                [
-                    # (key, timestamp, value)
-                    (f"guild:{guild.id}:members", "*", m_count),
-                    (f"guild:{guild.id}:sources", "*", join_type.value),
-                ]
-            )
-        )
+            last = await self.bot.redis.ts().get(f"guild:{guild.id}:members")
+            m_count = int(last[1]) + 1 if last else 1
 
-        await self.bot.redis.sadd(f"guild:{guild.id}:joins", member.id)
-
-        new_member = Member(
-            **{
-                "id": member.id,
-                "guild": member.guild.id,
-                "joined_at": member.joined_at.date(),
-                "ts": int(float(ts / 1000)),
-                "avatar": member.avatar.url
-                if member.avatar
-                else "https://discord.com/assets/322c936a8c8be1b803cd94861bdfa868.png",
-                "display_name": member.display_name,
-                "username": member.name,
-                "created_at": member.created_at.date(),
-                "join_type": join_type.name,
-                "inviter": invite.inviter.id if invite and join_type != JoinType.Vanity else 1,
-                "code_used": invite.code if invite else "",
-            }
+        new_member = member_document(
+            member, join_type.name, inviter=inviter, code=code
         )
-        await new_member.save()
-        if join_type ==  JoinType.Invite:
-            await self.bot.redis.incr(
-                f"guild:{guild.id}:invites:{invite.inviter.id}", 1
-            )
-            
-            code = invite.code
-            if roles := await self.bot.redis.smembers(f"{code}:roles"):
-                try:
-                    await member.add_roles(*[guild.get_role(int(r)) for r in roles])
-                except discord.Forbidden:
-                    await self.bot.redis.sadd(f"guild:{guild.id}:errors", "discord.Forbidden: discord permissions error to add roles")
-                except discord.HTTPException as e:
-                    await self.bot.redis.sadd(f"guild:{guild.id}:errors", f"discord.HTTPException: {e}")
-                else:
-                    await self.bot.redis.delete(f"guild:{guild.id}:errors")
-
-        # await self.bot.redis.hset("guild:{guild.id}:{ts}", "")
-        # turn off the error in the guild errors
-        await self.bot.redis.srem(
-            f"guild:{guild.id}:errors",
-            "discord.Forbidden discord permissions error "
-            + f"to fetch invites for guild {guild.name} ({guild.id})",
+        invited = join_type == JoinType.Invite
+        # every write of the join is committed atomically in one round trip
+        roles = await self.bot.writer.call(
+            scripts.JOIN,
+            keys=[
+                f"guild:{guild.id}:members",
+                f"guild:{guild.id}:sources",
+                f"guild:{guild.id}:joins",
+                new_member.key(),
+                f"guild:{guild.id}:member_pks",
+                f"guild:{guild.id}:lb:inviters" if invited and inviter else "",
+                f"guild:{guild.id}:errors",
+                f"{code}:roles" if invited else "",
+                f"guild:{guild.id}:lb:codes" if invited else "",
+            ],
+            args=[
+                int(time.time() * 1000),
+                m_count,
+                join_type.value,
+                member.id,
+                new_member.json(),
+                new_member.pk,
+                # turn off the error in the guild errors
+                "discord.Forbidden discord permissions error "
+                + f"to fetch invites for guild {guild.name} ({guild.id})",
+                join_type.name,
+                guild.id,
+                code or "",
+                RETENTION,
+                inviter or "",
+                int(time.time()) // 86400,
+                leaderboard.BUCKET_TTL,
+                new_member.ts // retention.WEEK,
+                retention.COHORT_TTL,
+            ],
         )
-        
-        
+
+        if roles:
+            try:
+                await member.add_roles(*[guild.get_role(int(r)) for r in roles])
+            except discord.Forbidden:
+                await self.bot.redis.sadd(f"guild:{guild.id}:errors", "discord.Forbidden: discord permissions error to add roles")
+            except discord.HTTPException as e:
+                await self.bot.redis.sadd(f"guild:{guild.id}:errors", f"discord.HTTPException: {e}")
+            else:
+                await self.bot.redis.delete(f"guild:{guild.id}:errors")
 
     @Cog.listener()
     async def on_member_remove(self, member: discord.Member) -> None:
         g = member.guild
         self.log.info("member count: %s", g.member_count)
-        try:
-            user_info = await Member.find(
-                (Member.id == member.id) & (Member.guild == g.id)
-            ).first()
-        except model.NotFoundError:
-            user_info = None
-
-        if user_info:
-            join_type = getattr(JoinType, user_info.join_type.title())
-            await Member.delete(user_info.pk)
-        else:
-            join_type = JoinType.NotTracked
-
-        # delete some boring data
-        async with self.bot.redis.pipeline(transaction=False) as pipe:
-            pipe.srem(f"guild:{g.id}:joins", member.id)
-            if join_type == JoinType.Invite.value:
-                pipe.decr(f"guild:{g.id}:invites:{user_info.inviter}", 1)
-            await pipe.execute()
-
-        await self.bot.redis.ts().madd(
-            [
-                (f"guild:{g.id}:members", "*", g.member_count),
-                (
-                    f"guild:{g.id}:sources.leave",
-                    "*",
-                    join_type.value if type(join_type) == JoinType else int(join_type),
-                )
-                # (f"guild:{g.id}:retention", "*", str((member.joined_at - datetime.now()).timestamp() * 1000))
-            ]
+        # the document lookup, deletes, counters and samples run in one script
+        await self.bot.writer.enqueue(
+            scripts.LEAVE,
+            keys=[
+                f"guild:{g.id}:member_pks",
+                f"guild:{g.id}:joins",
+                f"guild:{g.id}:members",
+                f"guild:{g.id}:sources.leave",
+                f"guild:{g.id}:retention",
+            ],
+            args=[
+                int(time.time() * 1000),
+                g.member_count if g.member_count is not None else "",
+                member.id,
+                g.id,
+                Member.make_key(""),
+                RETENTION,
+                *JOIN_TYPE_NAMES,
+            ],
         )
 
 
@@ -1,25 +1,10 @@
+import asyncio
 import discord
-from typing import List
-
-def compareInvites(old_inv: List[discord.Invite], new_inv: List[discord.Invite]) -> List[discord.Invite]:
-    """Return a list of invites that have updated"""
-    codes_used = []
-    old_obj = {i["code"]: i for i in old_inv}
-    # conversions because dpy returns a list
-    new_obj = {i["code"]: i for i in new_inv}
-    for key in new_obj.keys():
-        if int(new_obj[key]["uses"]) != 0 and (
-            not old_obj.get(key) or int(old_obj[key]["uses"]) < int(new_obj[key]["uses"])
-        ):
-            codes_used.append(key)
-    if len(codes_used) == 0:
-        for key in old_obj.keys():
-            if (
-                not new_obj.get(key)
-                and int(old_obj[key]["uses"]) == int(old_obj[key]["max_uses"]) - 1
-            ):
-                codes_used.append(key)
-    return codes_used
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from models import Member
+
+DEFAULT_AVATAR = "https://discord.com/assets/322c936a8c8be1b803cd94861bdfa868.png"
 
 def dump_invite(invite: discord.Invite) -> dict:
     if not invite:
@@ -28,4 +13,89 @@ def dump_invite(invite: discord.Invite) -> dict:
         "code": invite.code,
         "uses": invite.uses,
         "max_uses": invite.max_uses
-    }
\ No newline at end of file
+    }
+
+
+def member_document(
+    member: discord.Member,
+    join_type: str,
+    *,
+    inviter: Optional[int] = None,
+    code: Optional[str] = None,
+) -> Member:
+    return Member(
+        **{
+            "id": member.id,
+            "guild": member.guild.id,
+            "joined_at": member.joined_at.date(),
+            "ts": int(member.joined_at.timestamp()),
+            "avatar": member.avatar.url if member.avatar else DEFAULT_AVATAR,
+            "display_name": member.display_name,
+            "username": member.name,
+            "created_at": member.created_at.date(),
+            "join_type": join_type,
+            "inviter": inviter or 1,
+            "code_used": code or "",
+        }
+    )
+
+
+class JoinCoalescer:
+    """Collect member joins per guild and resolve them with a single snapshot
+
+    The first join for a guild opens a batch which stays open for ``window``
+    seconds. Every join arriving in that time is attributed by one call to
+    ``resolve`` and only one batch per guild is ever in flight, so concurrent
+    handlers can't overwrite each other's invite snapshot.
+    """
+
+    def __init__(
+        self,
+        resolve: Callable[[discord.Guild, List[discord.Member]], Awaitable[Optional[list]]],
+        *,
+        window: float = 0.5,
+    ):
+        self.resolve = resolve
+        self.window = window
+        self.pending: Dict[int, List[Tuple[discord.Member, asyncio.Future]]] = {}
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.batches = 0
+        self.joins = 0
+
+    async def submit(self, guild: discord.Guild, member: discord.Member):
+        """Queue a member and wait for the result of its batch"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(guild.id, []).append((member, future))
+        if guild.id not in self.tasks:
+            self.tasks[guild.id] = asyncio.create_task(self._run(guild))
+        return await future
+
+    async def _run(self, guild: discord.Guild) -> None:
+        try:
+            # joins arriving while a batch resolves wait for the next batch
+            while self.pending.get(guild.id):
+                await asyncio.sleep(self.window)
+                batch = self.pending.pop(guild.id, [])
+                self.batches += 1
+                self.joins += len(batch)
+                try:
+                    results = await self.resolve(guild, [m for m, _ in batch])
+                except Exception as e:  # pylint: disable=broad-except
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for i, (_, future) in enumerate(batch):
+                    if not future.done():
+                        future.set_result(results[i] if results else None)
+        finally:
+            self.tasks.pop(guild.id, None)
+
+    def cancel(self) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+        for batch in self.pending.values():
+            for _, future in batch:
+                future.cancel()
+        self.tasks.clear()
+        self.pending.clear()
@@ -0,0 +1,130 @@
+import asyncio
+import time
+from logging import Logger
+from typing import Awaitable, Callable, List, Optional
+
+import discord
+import redis.asyncio as redis
+
+
+class RateLimiter:
+    """Token bucket shared by every warm-up worker
+
+    discord.py already waits on the per-route buckets (guild invites are
+    bucketed per guild), this keeps the warm-up well under the global limit
+    so live handlers still get their requests through.
+    """
+
+    def __init__(self, rate: float, *, burst: Optional[int] = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+                self.waited += delay
+                await asyncio.sleep(delay)
+
+
+class WarmUp:
+    """Warm up guilds concurrently, busiest first, skipping recent ones
+
+    Guilds are ordered by their last join (``activity_key``) and each one
+    that finishes is recorded in ``done_key`` so a reconnect that fires
+    ``on_ready`` again skips anything warmed within ``ttl`` seconds. The key
+    expires ``ttl`` seconds after the last guild was warmed.
+    """
+
+    activity_key = "guilds:activity"
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        warm: Callable[[discord.Guild], Awaitable[bool]],
+        *,
+        done_key: str,
+        log: Logger,
+        concurrency: int = 8,
+        rate: float = 25,
+        ttl: int = 600,
+    ):
+        self.redis = client
+        self.warm = warm
+        self.done_key = done_key
+        self.log = log
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.ttl = ttl
+
+    async def plan(self, guilds: List[discord.Guild]) -> List[discord.Guild]:
+        """Drop recently warmed guilds and order the rest by join activity"""
+        if not guilds:
+            return []
+        ids = [guild.id for guild in guilds]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zmscore(self.done_key, ids)
+            pipe.zmscore(self.activity_key, ids)
+            done, activity = await pipe.execute()
+
+        cutoff = time.time() - self.ttl
+        pending = [
+            (activity[i] or 0, guild)
+            for i, guild in enumerate(guilds)
+            if not done[i] or done[i] < cutoff
+        ]
+        pending.sort(key=lambda x: x[0], reverse=True)
+        return [guild for _, guild in pending]
+
+    async def run(self, guilds: List[discord.Guild]) -> int:
+        queue = await self.plan(guilds)
+        skipped = len(guilds) - len(queue)
+        start = time.perf_counter()
+        warmed = failed = 0
+        guild_iter = iter(queue)
+
+        async def worker():
+            nonlocal warmed, failed
+            for guild in guild_iter:
+                await self.limiter.acquire()
+                try:
+                    ok = await self.warm(guild)
+                except Exception:  # pylint: disable=broad-except
+                    self.log.exception("Failed to warm up guild %s", guild.id)
+                    failed += 1
+                    continue
+                if ok:
+                    async with self.redis.pipeline(transaction=False) as pipe:
+                        pipe.zadd(self.done_key, {guild.id: time.time()})
+                        pipe.expire(self.done_key, self.ttl)
+                        await pipe.execute()
+                    warmed += 1
+                if (warmed + failed) % 100 == 0:
+                    self.log.info("Warm-up progress: %s/%s", warmed + failed, len(queue))
+
+        await asyncio.gather(
+            *(worker() for _ in range(min(self.concurrency, len(queue)) or 1))
+        )
+        elapsed = time.perf_counter() - start
+        self.log.info(
+            "Warmed up %s guilds in %.2fs (%.1f guilds/s), %s skipped, %s failed, %.2fs rate limited",
+            warmed,
+            elapsed,
+            warmed / elapsed if elapsed else 0,
+            skipped,
+            failed,
+            self.limiter.waited,
+        )
+        return warmed
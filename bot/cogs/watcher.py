@@ -1,60 +1,128 @@
-import inspect
+import asyncio
+import importlib
 import os
-import traceback
-from asyncio import set_event_loop
-from typing import TYPE_CHECKING
+import sys
+from typing import TYPE_CHECKING, Dict, Optional, Set
+
 from discord.ext.commands import Cog
-from discord.ext.tasks import loop
 
-class MonkeyWatcher(Cog):
-    def __init__(self, bot):
-        self.bot = bot
-        self.cache = {}
+if TYPE_CHECKING:
+    from ..bot import Bot
+
+
+class Reloader(Cog):
+    """Reload extensions when their files change, for development
+
+    Only loaded with RELOAD set. File system notifications come from
+    watchdog's observer thread, so nothing runs while no file changes, and
+    a burst of saves turns into one reload after ``debounce`` seconds.
+
+    Cogs can keep their in-memory state across a reload: ``export_state``
+    is called on the old instance and its result handed to
+    ``import_state`` of the new one.
+    """
+
+    def __init__(self, bot, *, debounce: float = 0.5):
+        # only needed while developing, watchdog isn't imported otherwise
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+
+        self.bot: "Bot" = bot
+        self.debounce = debounce
         self.log = bot.log.getChild(type(self).__name__)
+        self.loop = asyncio.get_running_loop()
+        self.changed: Set[str] = set()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.lock = asyncio.Lock()
+
+        reloader = self
 
-        self.watcher.start()
-
-    @loop(seconds=1)
-    async def watcher(self):
-        for name, module in self.bot.extensions.copy().items():
-            folder = False
-            if module.__file__.endswith("__init__.py"):
-                # it's a folder
-                folder = True
-                fpath = module.__file__[:-11]
-            if folder:
-                stat = {
-                    name: int(os.stat(os.path.join(fpath, name)).st_mtime)
-                    for name in os.listdir(fpath)
-                    if name.endswith(".py")
-                }
-            else:
-                stat = int(os.stat(inspect.getfile(module)).st_mtime)
-
-            if name not in self.cache:
-                self.cache[name] = stat
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                path = getattr(event, "dest_path", "") or event.src_path
+                if not event.is_directory and path.endswith(".py"):
+                    reloader.loop.call_soon_threadsafe(reloader.schedule, path)
+
+        self.observer = Observer()
+        for folder in self.folders():
+            self.observer.schedule(Handler(), folder, recursive=False)
+        self.observer.start()
+
+    def folders(self) -> Set[str]:
+        return {
+            os.path.dirname(os.path.abspath(module.__file__))
+            for module in self.bot.extensions.values()
+        }
+
+    def schedule(self, path: str) -> None:
+        self.changed.add(os.path.abspath(path))
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_later(
+            self.debounce, lambda: asyncio.ensure_future(self.reload_changed())
+        )
+
+    def affected(self, paths: Set[str]) -> Set[str]:
+        """Extensions to reload for the changed files, reloading changed helper modules"""
+        files: Dict[str, str] = {
+            os.path.abspath(module.__file__): name
+            for name, module in self.bot.extensions.items()
+        }
+        names = set()
+        for path in paths:
+            if path in files:
+                names.add(files[path])
                 continue
+            helpers = [
+                module
+                for module in list(sys.modules.values())
+                if os.path.abspath(getattr(module, "__file__", None) or "") == path
+            ]
+            if not helpers:
+                continue
+            # a helper module is reloaded itself, then every extension next to it
+            for module in helpers:
+                importlib.reload(module)
+            folder = os.path.dirname(path)
+            names.update(name for file, name in files.items() if os.path.dirname(file) == folder)
+        # reloading the reloader from its own task would stop the observer under it
+        names.discard(__name__)
+        return names
+
+    async def reload_changed(self) -> None:
+        async with self.lock:
+            paths, self.changed = self.changed, set()
+            try:
+                names = self.affected(paths)
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception("Failed to reload helper modules")
+                return
+            for name in sorted(names):
+                await self.reload(name)
 
-            if stat != self.cache.get(name):
-                self.cache[name] = stat
-                self.log.debug(f"Reloading: {name}")
-                try:
-                    await self.bot.reload_extension(name)
-                except: # pylint: disable=bare-except
-                    traceback.print_exc()
-                else:
-                    self.log.info(f"Reloaded: {name}")
-
-    @watcher.before_loop
-    async def waiter(self):
-        await self.bot.wait_until_ready()
-        return True
+    async def reload(self, name: str) -> None:
+        states = {
+            cog_name: cog.export_state()
+            for cog_name, cog in self.bot.cogs.items()
+            if cog.__module__ == name and hasattr(cog, "export_state")
+        }
+        self.log.debug("Reloading: %s", name)
+        try:
+            await self.bot.reload_extension(name)
+        except Exception:  # pylint: disable=broad-except
+            self.log.exception("Failed to reload %s", name)
+            return
+        for cog_name, state in states.items():
+            if (cog := self.bot.get_cog(cog_name)) is not None and hasattr(cog, "import_state"):
+                cog.import_state(state)
+        self.log.info("Reloaded: %s (%s cogs kept their state)", name, len(states))
 
     async def cog_unload(self):
-        self.watcher.stop()  # pylint: disable=no-member
+        if self.timer is not None:
+            self.timer.cancel()
+        self.observer.stop()
+        await asyncio.to_thread(self.observer.join)
 
 
 async def setup(bot):
-    cog = MonkeyWatcher(bot)
-
-    await bot.add_cog(cog)
+    await bot.add_cog(Reloader(bot, debounce=float(os.getenv("RELOAD_DEBOUNCE", "0.5"))))
@@ -0,0 +1,519 @@
+"""Offline load test and replay harness for the tracking cog
+
+Replays a synthetic or recorded event trace through MemberTracking's
+listeners against fake guilds and invites, so nothing talks to Discord.
+Redis has to be a local redis-stack (the scripts need RedisTimeSeries,
+RedisJSON and RediSearch) reached through the usual REDIS_HOST, REDIS_PORT
+and REDIS_OM_URL variables. Use a throwaway instance, the synthetic guilds
+are written exactly like real ones.
+
+    python harness.py --guilds 20 --joins 20000 --output run.json
+    python harness.py --trace raid.jsonl --baseline run.json
+    INDEX_PROFILE=full python harness.py --write-bench 1000000 --output full.json
+    INDEX_PROFILE=lean python harness.py --write-bench 1000000 --baseline full.json
+
+A trace is JSON lines, ``t`` is the offset in seconds:
+
+    {"t": 0, "type": "guild", "guild": 1, "members": 500, "vanity": "abc",
+     "invites": [{"code": "x", "uses": 0, "max_uses": 0, "inviter": 7}]}
+    {"t": 0, "type": "ready"}
+    {"t": 0.5, "type": "join", "guild": 1, "member": 42, "via": "x"}
+    {"t": 0.9, "type": "leave", "guild": 1, "member": 42}
+    {"t": 1.0, "type": "invite_create", "guild": 1, "code": "y", "inviter": 7}
+    {"t": 1.2, "type": "invite_delete", "guild": 1, "code": "y"}
+
+``via`` is the ground truth of a join: an invite code, "vanity" or
+"discovery".
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional
+
+import discord
+
+from bot import Bot
+from cogs.invitetracking import MemberTracking
+from cogs.utils import member_document
+from indexes import index_info
+from models import INDEX_PROFILE, Member
+
+# ids far above real snowflakes so a run can't collide with real guilds
+BASE_ID = 9 * 10**18
+
+
+class FakeObject:
+    def __init__(self, id: int):
+        self.id = id
+
+
+class FakeUser(FakeObject):
+    def __init__(self, id: int):
+        super().__init__(id)
+        self.name = f"user{id}"
+        self.display_name = self.name
+        self.avatar = None
+        self.bot = False
+        self.created_at = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeInvite:
+    def __init__(self, guild: "FakeGuild", code: str, *, uses=0, max_uses=0, inviter=None):
+        self.guild = guild
+        self.code = code
+        self.uses = uses
+        self.max_uses = max_uses
+        self.inviter = FakeUser(inviter) if inviter else None
+        self.channel = FakeObject(guild.id)
+        self.created_at = datetime.now(timezone.utc)
+        self.expires_at = None
+        self.temporary = False
+
+    @property
+    def url(self) -> str:
+        return f"https://discord.gg/{self.code}"
+
+
+class FakeMember(FakeUser):
+    def __init__(self, id: int, guild: "FakeGuild"):
+        super().__init__(id)
+        self.guild = guild
+        self.joined_at = datetime.now(timezone.utc)
+
+    async def add_roles(self, *roles) -> None:
+        self.guild.rest["member.add_roles"] += 1
+
+
+class FakeGuild(FakeObject):
+    """Just enough of a discord.Guild for the tracking cog, counting REST calls"""
+
+    def __init__(self, id: int, rest: Counter, *, members: int = 0, vanity: Optional[str] = None):
+        super().__init__(id)
+        self.rest = rest
+        self.name = f"guild{id}"
+        self.member_count = members
+        self.owner_id = BASE_ID
+        self.icon = None
+        self.banner = None
+        self.description = ""
+        self.preferred_locale = "en-US"
+        self.roles = []
+        self.features = ["VANITY_URL"] if vanity else []
+        self.invites_by_code: Dict[str, FakeInvite] = {}
+        self.vanity = FakeInvite(self, vanity) if vanity else None
+
+    async def invites(self) -> List[FakeInvite]:
+        self.rest["guild.invites"] += 1
+        return list(self.invites_by_code.values())
+
+    async def vanity_invite(self) -> Optional[FakeInvite]:
+        self.rest["guild.vanity_invite"] += 1
+        return self.vanity
+
+    def get_role(self, role_id: int):
+        return None
+
+
+class HarnessBot(Bot):
+    def __init__(self):
+        super().__init__(intents=discord.Intents.default())
+        self.rest: Counter = Counter()
+        self.fake_guilds: Dict[int, FakeGuild] = {}
+        self._user = FakeUser(BASE_ID)
+
+    @property
+    def user(self):
+        return self._user
+
+    @property
+    def guilds(self):
+        return list(self.fake_guilds.values())
+
+    def get_guild(self, guild_id: int, /):
+        return self.fake_guilds.get(guild_id)
+
+    async def fetch_guild(self, guild_id: int, /, **kwargs):
+        self.rest["fetch_guild"] += 1
+        return self.fake_guilds[guild_id]
+
+    async def fetch_invite(self, url, **kwargs):
+        self.rest["fetch_invite"] += 1
+        code = str(url).rsplit("/", 1)[-1]
+        for guild in self.fake_guilds.values():
+            if code in guild.invites_by_code:
+                return guild.invites_by_code[code]
+        # gone already, the cog then stores the join without an inviter
+        return FakeInvite(next(iter(self.fake_guilds.values())), code)
+
+
+def synthetic_trace(
+    *, guilds: int, joins: int, invites: int, rate: float, leave_ratio: float, seed: int
+) -> Iterator[dict]:
+    """A raid-shaped trace: a few hot invites, single-use ones, vanity and discovery joins"""
+    rng = random.Random(seed)
+    codes: Dict[int, List[str]] = {}
+    for g in range(guilds):
+        guild_id = BASE_ID + g + 1
+        codes[guild_id] = [f"h{g}x{i}" for i in range(invites)]
+        yield {
+            "t": 0,
+            "type": "guild",
+            "guild": guild_id,
+            "members": rng.randint(100, 100000),
+            "vanity": f"h{g}vanity" if g % 4 == 0 else None,
+            "invites": [
+                {
+                    "code": code,
+                    "uses": rng.randint(0, 50),
+                    "max_uses": 1 if i % 10 == 9 else 0,
+                    "inviter": BASE_ID + 10**6 + rng.randint(0, 100),
+                }
+                for i, code in enumerate(codes[guild_id])
+            ],
+        }
+    yield {"t": 0, "type": "ready"}
+
+    ids = list(codes)
+    weights = [1 / (i + 1) for i in range(len(ids))]
+    joined: List[tuple] = []
+    t = 1.0
+    for n in range(joins):
+        t += rng.expovariate(rate)
+        guild_id = rng.choices(ids, weights)[0]
+        roll = rng.random()
+        if roll < 0.05:
+            via = "discovery"
+        elif roll < 0.1:
+            via = "vanity"
+        else:
+            # a zipf-ish spread, the first few invites carry most joins
+            pool = codes[guild_id]
+            via = pool[min(int(rng.paretovariate(1.2)) - 1, len(pool) - 1)]
+        member = BASE_ID + 10**7 + n
+        yield {"t": round(t, 4), "type": "join", "guild": guild_id, "member": member, "via": via}
+        joined.append((guild_id, member))
+        if rng.random() < leave_ratio and len(joined) > 100:
+            guild_id, member = joined.pop(rng.randrange(len(joined) - 100))
+            yield {"t": round(t, 4), "type": "leave", "guild": guild_id, "member": member}
+        if rng.random() < 0.01:
+            code = f"h{ids.index(guild_id)}y{n}"
+            codes[guild_id].append(code)
+            yield {
+                "t": round(t, 4),
+                "type": "invite_create",
+                "guild": guild_id,
+                "code": code,
+                "inviter": BASE_ID + 10**6 + rng.randint(0, 100),
+            }
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def command_count(client) -> int:
+    stats = await client.info("commandstats")
+    return sum(stat["calls"] for stat in stats.values())
+
+
+class Harness:
+    def __init__(self, bot: HarnessBot, cog: MemberTracking, *, speed: float):
+        self.bot = bot
+        self.cog = cog
+        self.speed = speed
+        self.members: Dict[int, FakeMember] = {}
+        self.expected: Dict[int, tuple] = {}
+        self.attributed: Dict[int, tuple] = {}
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.tasks: List[asyncio.Task] = []
+        self.events = 0
+
+        resolve = cog.joins.resolve
+
+        async def capture(guild, members):
+            results = await resolve(guild, members)
+            for member, result in zip(members, results or []):
+                self.attributed[member.id] = (result.join_type.name, result.code)
+            return results
+
+        cog.joins.resolve = capture
+
+    def dispatch(self, kind: str, handler, *args) -> None:
+        # the gateway runs every listener as its own task
+        async def timed():
+            start = time.perf_counter()
+            try:
+                await handler(*args)
+            except Exception:  # pylint: disable=broad-except
+                self.bot.log.exception("Handler %s failed", kind)
+                self.latencies[f"{kind}.failed"].append(0)
+                return
+            self.latencies[kind].append(time.perf_counter() - start)
+
+        self.events += 1
+        self.tasks.append(asyncio.create_task(timed()))
+
+    def apply(self, event: dict) -> None:
+        """Change the fake Discord state the way the real event would, then dispatch it"""
+        kind = event["type"]
+        guild = self.bot.fake_guilds.get(event.get("guild"))
+        if kind == "guild":
+            guild = FakeGuild(
+                event["guild"], self.bot.rest, members=event.get("members", 0), vanity=event.get("vanity")
+            )
+            for spec in event.get("invites", []):
+                guild.invites_by_code[spec["code"]] = FakeInvite(
+                    guild,
+                    spec["code"],
+                    uses=spec.get("uses", 0),
+                    max_uses=spec.get("max_uses", 0),
+                    inviter=spec.get("inviter"),
+                )
+            self.bot.fake_guilds[guild.id] = guild
+        elif kind == "ready":
+            self.dispatch("ready", self.cog.on_ready)
+        elif kind == "join":
+            member = FakeMember(event["member"], guild)
+            self.members[member.id] = member
+            guild.member_count += 1
+            via = event["via"]
+            if via == "vanity" and guild.vanity:
+                guild.vanity.uses += 1
+                self.expected[member.id] = ("Vanity", guild.vanity.code)
+            elif via in guild.invites_by_code:
+                invite = guild.invites_by_code[via]
+                invite.uses += 1
+                self.expected[member.id] = ("Invite", via)
+                if invite.max_uses and invite.uses >= invite.max_uses:
+                    # discord deletes a used up invite right away
+                    del guild.invites_by_code[via]
+                    self.dispatch("join", self.cog.on_member_join, member)
+                    self.dispatch("invite_delete", self.cog.on_invite_delete, invite)
+                    return
+            else:
+                self.expected[member.id] = ("Discovery", None)
+            self.dispatch("join", self.cog.on_member_join, member)
+        elif kind == "leave":
+            member = self.members.pop(event["member"], None) or FakeMember(event["member"], guild)
+            guild.member_count -= 1
+            self.dispatch("leave", self.cog.on_member_remove, member)
+        elif kind == "invite_create":
+            invite = FakeInvite(guild, event["code"], max_uses=event.get("max_uses", 0), inviter=event.get("inviter"))
+            guild.invites_by_code[invite.code] = invite
+            self.dispatch("invite_create", self.cog.on_invite_create, invite)
+        elif kind == "invite_delete":
+            if (invite := guild.invites_by_code.pop(event["code"], None)) is not None:
+                self.dispatch("invite_delete", self.cog.on_invite_delete, invite)
+
+    async def replay(self, trace: Iterator[dict]) -> float:
+        start = time.perf_counter()
+        for event in trace:
+            if self.speed and (delay := event["t"] / self.speed - (time.perf_counter() - start)) > 0:
+                await asyncio.sleep(delay)
+            self.apply(event)
+            if event["type"] == "ready":
+                # the gateway only sends events once the guilds are ready
+                await self.tasks[-1]
+            elif len(self.tasks) % 100 == 0:
+                await asyncio.sleep(0)
+        await asyncio.gather(*self.tasks)
+        return time.perf_counter() - start
+
+    def report(self, elapsed: float, commands: int) -> dict:
+        scored = [member for member in self.expected if member in self.attributed]
+        correct = sum(self.expected[m] == self.attributed[m] for m in scored)
+        rest = sum(self.bot.rest.values())
+        return {
+            "events": self.events,
+            "elapsed": round(elapsed, 3),
+            "events_per_s": round(self.events / elapsed, 1) if elapsed else 0,
+            "latency": {
+                kind: {
+                    "count": len(values),
+                    "p50_ms": round(percentile(values, 0.5) * 1000, 3),
+                    "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+                }
+                for kind, values in sorted(self.latencies.items())
+            },
+            "redis_commands_per_event": round(commands / self.events, 2) if self.events else 0,
+            "rest_calls_per_event": round(rest / self.events, 3) if self.events else 0,
+            "rest_calls": dict(self.bot.rest),
+            "fallbacks": dict(self.cog.fallbacks),
+            "attribution": {
+                "joins": len(self.expected),
+                "scored": len(scored),
+                "correct": correct,
+                "accuracy": round(correct / len(scored), 4) if scored else 0,
+                "errors": dict(
+                    Counter(
+                        f"{self.expected[m][0]}->{self.attributed[m][0]}"
+                        for m in scored
+                        if self.expected[m] != self.attributed[m]
+                    )
+                ),
+            },
+        }
+
+
+async def write_benchmark(bot: HarnessBot, members: int, *, batch: int = 1000) -> dict:
+    """Member document writes per second against the current index profile"""
+    # a rebuild in the background would be timed along with the writes
+    await asyncio.gather(*bot.index_tasks)
+    guild = FakeGuild(BASE_ID, bot.rest)
+    name = Member.Meta.index_name
+    before = await index_info(bot.redis, name) or {}
+    keys: List[str] = []
+    written = 0.0
+    for start in range(0, members, batch):
+        docs = [
+            member_document(
+                FakeMember(BASE_ID + start + i + 1, guild), "Invite", inviter=BASE_ID, code="bench"
+            )
+            for i in range(min(batch, members - start))
+        ]
+        began = time.perf_counter()
+        async with bot.redis.pipeline(transaction=False) as pipe:
+            for doc in docs:
+                # the JOIN script writes the document the same way
+                pipe.execute_command("JSON.SET", doc.key(), "$", doc.json())
+            await pipe.execute()
+        written += time.perf_counter() - began
+        keys.extend(doc.key() for doc in docs)
+    after = await index_info(bot.redis, name) or {}
+
+    for start in range(0, len(keys), batch):
+        await bot.redis.unlink(*keys[start : start + batch])
+    return {
+        "profile": INDEX_PROFILE,
+        "members": members,
+        "elapsed": round(written, 3),
+        "writes_per_s": round(members / written, 1) if written else 0,
+        "index_mb": {
+            field: round(float(after.get(field, 0)) - float(before.get(field, 0)), 2)
+            for field in ("inverted_sz_mb", "offset_vectors_sz_mb", "doc_table_size_mb", "key_table_size_mb")
+        },
+    }
+
+
+# (path, True when higher is better)
+COMPARED = [
+    (("writes_per_s",), True),
+    (("events_per_s",), True),
+    (("redis_commands_per_event",), False),
+    (("rest_calls_per_event",), False),
+    (("attribution", "accuracy"), True),
+]
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Lines describing every metric that regressed beyond ``tolerance``"""
+    metrics = list(COMPARED) + [
+        (("latency", kind, "p99_ms"), False) for kind in baseline.get("latency", {})
+    ]
+    regressions = []
+    for path, higher in metrics:
+        old, new = baseline, report
+        for part in path:
+            old, new = (old or {}).get(part), (new or {}).get(part)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0
+        line = f"{'.'.join(path)}: {old} -> {new} ({change:+.1%})"
+        print(line)
+        if (change < -tolerance) if higher else (change > tolerance):
+            regressions.append(line)
+    return regressions
+
+
+async def main(args) -> int:
+    if args.write_bench:
+        bot = HarnessBot()
+        await bot.start_services()
+        try:
+            report = await write_benchmark(bot, args.write_bench)
+        finally:
+            await bot.stop_services()
+        return finish(report, args)
+
+    if args.trace:
+        with open(args.trace) as f:
+            trace = [json.loads(line) for line in f if line.strip()]
+    else:
+        trace = list(
+            synthetic_trace(
+                guilds=args.guilds,
+                joins=args.joins,
+                invites=args.invites,
+                rate=args.rate,
+                leave_ratio=args.leaves,
+                seed=args.seed,
+            )
+        )
+    if args.record:
+        with open(args.record, "w") as f:
+            f.writelines(json.dumps(event) + "\n" for event in trace)
+
+    bot = HarnessBot()
+    await bot.start_services()
+    cog = MemberTracking(bot)
+    harness = Harness(bot, cog, speed=args.speed)
+    before = await command_count(bot.redis)
+    try:
+        elapsed = await harness.replay(iter(trace))
+    finally:
+        await cog.cog_unload()
+        await bot.stop_services()
+    # every command the run issued, the ones inside scripts included
+    commands = await command_count(bot.redis) - before - 1
+
+    return finish(harness.report(elapsed, commands), args)
+
+
+def finish(report: dict, args) -> int:
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressed beyond %.0f%%:" % (args.tolerance * 100))
+            print("\n".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--trace", help="replay a recorded JSON lines trace")
+    parser.add_argument("--record", help="write the trace that was replayed")
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument("--joins", type=int, default=5000)
+    parser.add_argument("--invites", type=int, default=50, help="invites per guild")
+    parser.add_argument("--rate", type=float, default=500, help="synthetic joins per second")
+    parser.add_argument("--leaves", type=float, default=0.3, help="leaves per join")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--speed", type=float, default=0, help="replay speed factor, 0 replays as fast as possible"
+    )
+    parser.add_argument(
+        "--write-bench", type=int, default=0, metavar="MEMBERS",
+        help="time writing this many member documents instead of replaying a trace",
+    )
+    parser.add_argument("--output", help="write the report as JSON")
+    parser.add_argument("--baseline", help="compare against a previous report")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,120 @@
+"""RediSearch index migrations that keep the old index serving until the new one is built"""
+import asyncio
+import hashlib
+from logging import getLogger
+from typing import Iterable, List, Optional, Type
+
+from aredis_om import JsonModel
+from redis.exceptions import ResponseError
+
+log = getLogger("discord.app").getChild("indexes")
+
+# fingerprint of every model schema as of the last completed migration
+FINGERPRINT_KEY = "indexes:fingerprint"
+
+
+def schema_hash(schema: str) -> str:
+    # same fingerprint aredis_om's Migrator stores in "{index}:hash"
+    return hashlib.sha1(schema.encode("utf-8")).hexdigest()
+
+
+async def index_info(conn, name: str) -> Optional[dict]:
+    try:
+        info = await conn.execute_command("FT.INFO", name)
+    except ResponseError:
+        return None
+    return dict(zip(info[::2], info[1::2]))
+
+
+async def migrate_index(model: Type[JsonModel]) -> Optional[asyncio.Task]:
+    """Create or rebuild a model's index if its schema changed
+
+    A rebuild runs in the background and is returned as a task, queries keep
+    hitting the previous index until the swap.
+    """
+    try:
+        schema = model.redisearch_schema()
+    except NotImplementedError:
+        return None
+    if schema.rstrip().endswith("SCHEMA"):
+        # nothing indexed in this profile
+        return None
+    conn = model.db()
+    name = model.Meta.index_name
+    current = schema_hash(schema)
+
+    if await index_info(conn, name) is None:
+        await conn.execute_command(f"FT.CREATE {name} {schema}")
+        await conn.set(f"{name}:hash", current)
+        log.info("Created index %s", name)
+        return None
+
+    if await conn.get(f"{name}:hash") == current:
+        return None
+    return asyncio.create_task(rebuild_index(model, schema, current))
+
+
+async def rebuild_index(model: Type[JsonModel], schema: str, current: str) -> None:
+    conn = model.db()
+    name = model.Meta.index_name
+    target = f"{name}:{current[:8]}"
+    log.info("Rebuilding index %s as %s", name, target)
+
+    if await index_info(conn, target) is None:
+        await conn.execute_command(f"FT.CREATE {target} {schema}")
+    while True:
+        info = await index_info(conn, target)
+        if int(info.get("indexing", 0)) == 0:
+            break
+        log.debug("Index %s at %s", target, info.get("percent_indexed"))
+        await asyncio.sleep(1)
+
+    # the public name becomes an alias of the new index
+    served = (await index_info(conn, name)).get("index_name", name)
+    if served == target:
+        await conn.set(f"{name}:hash", current)
+        return
+    async with conn.pipeline(transaction=True) as pipe:
+        if served == name:
+            pipe.execute_command("FT.DROPINDEX", name)
+            pipe.execute_command("FT.ALIASADD", name, target)
+        else:
+            pipe.execute_command("FT.ALIASUPDATE", name, target)
+            pipe.execute_command("FT.DROPINDEX", served)
+        pipe.set(f"{name}:hash", current)
+        await pipe.execute()
+    log.info("Index %s now served by %s", name, target)
+
+
+def fingerprint(models: Iterable[Type[JsonModel]]) -> str:
+    parts = []
+    for model in models:
+        try:
+            parts.append(f"{model.Meta.index_name} {model.redisearch_schema()}")
+        except NotImplementedError:
+            continue
+    return schema_hash("\n".join(parts))
+
+
+async def migrate_indexes(conn, models: List[Type[JsonModel]]) -> List[asyncio.Task]:
+    """Migrate every model, or nothing at all if no schema changed since the last run
+
+    An unchanged fleet costs a single GET instead of FT.INFO and a GET per
+    model. Delete ``indexes:fingerprint`` to force the full check.
+    """
+    current = fingerprint(models)
+    if await conn.get(FINGERPRINT_KEY) == current:
+        log.debug("Index schemas unchanged (%s)", current[:8])
+        return []
+    tasks = [task for model in models if (task := await migrate_index(model))]
+
+    async def record():
+        # only once every rebuild went through
+        await asyncio.gather(*tasks)
+        await conn.set(FINGERPRINT_KEY, current)
+
+    if tasks:
+        asyncio.create_task(record())
+    else:
+        await conn.set(FINGERPRINT_KEY, current)
+    return tasks
@@ -0,0 +1,54 @@
+"""Inviter and invite code leaderboards kept in per-guild sorted sets"""
+from typing import List, Optional, Tuple
+
+import redis.asyncio as redis
+
+# rolling windows in days, built from the daily buckets the join script writes
+WINDOWS = {"7d": 7, "30d": 30}
+# a day bucket has to outlive the longest window
+BUCKET_TTL = (max(WINDOWS.values()) + 1) * 86400
+# how long a merged window stays cached
+WINDOW_TTL = 60
+
+
+def board_key(guild_id: int, kind: str) -> str:
+    return f"guild:{guild_id}:lb:{kind}"
+
+
+async def resolve(
+    client: redis.Redis, guild_id: int, kind: str, window: Optional[str], today: int
+) -> str:
+    """Return the sorted set holding a window, merging day buckets if needed"""
+    board = board_key(guild_id, kind)
+    if window is None:
+        return board
+    key = f"{board}:{window}"
+    if not await client.exists(key):
+        days = [f"{board}:{day}" for day in range(today - WINDOWS[window] + 1, today + 1)]
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.zunionstore(key, days)
+            pipe.expire(key, WINDOW_TTL)
+            await pipe.execute()
+    return key
+
+
+async def top(
+    client: redis.Redis, key: str, k: int = 10
+) -> List[Tuple[str, int]]:
+    return [
+        (member, int(score))
+        for member, score in await client.zrevrange(key, 0, k - 1, withscores=True)
+    ]
+
+
+async def rank(
+    client: redis.Redis, key: str, member: str
+) -> Optional[Tuple[int, int]]:
+    """1-based rank and score of a member, None if it has no credit"""
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.zrevrank(key, member)
+        pipe.zscore(key, member)
+        position, score = await pipe.execute()
+    if position is None:
+        return None
+    return position + 1, int(score)
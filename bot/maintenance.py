@@ -0,0 +1,270 @@
+"""One-off maintenance jobs, run by owners through the admin cog"""
+import time
+from typing import Dict, List
+
+import redis.asyncio as redis
+from redis.exceptions import ResponseError
+
+import leaderboard
+from models import Member
+from schema import DAY, RETENTION, ROLLUPS
+from scripts import STATS_DAYS
+
+
+async def backfill_member_index(client: redis.Redis, *, batch: int = 500) -> int:
+    """Build the guild:{id}:member_pks mapping for existing Member documents"""
+    count = 0
+    keys: List[str] = []
+
+    async def flush() -> int:
+        async with client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.json().get(key, "$.id", "$.guild")
+            # a key deleted or replaced since the scan mustn't stop the migration
+            docs = await pipe.execute(raise_on_error=False)
+
+        mapping: Dict[str, Dict[str, str]] = {}
+        for key, doc in zip(keys, docs):
+            if not isinstance(doc, dict) or not doc.get("$.id") or not doc.get("$.guild"):
+                continue
+            member_id, guild_id = doc["$.id"][0], doc["$.guild"][0]
+            mapping.setdefault(guild_id, {})[member_id] = key.rsplit(":", 1)[-1]
+
+        async with client.pipeline(transaction=False) as pipe:
+            for guild_id, members in mapping.items():
+                pipe.hset(f"guild:{guild_id}:member_pks", mapping=members)
+            await pipe.execute()
+        keys.clear()
+        return sum(len(members) for members in mapping.values())
+
+    # the index migration hash shares the prefix, only documents are wanted
+    async for key in client.scan_iter(
+        match=Member.make_key("*"), count=batch, _type="ReJSON-RL"
+    ):
+        keys.append(key)
+        if len(keys) >= batch:
+            count += await flush()
+    if keys:
+        count += await flush()
+    return count
+
+
+async def backfill_rollups(
+    client: redis.Redis, guild_id: int, *, raw_retention: int = 0
+) -> int:
+    """Fill the rollup series with the buckets that predate their rules
+
+    The first compacted bucket is recomputed as well, the rule was created
+    partway through it and only aggregated the samples added afterwards.
+    With ``raw_retention`` the raw series are shortened afterwards, since the
+    dashboard no longer reads old raw samples.
+    """
+    count = 0
+    for source, rollup, aggregation, bucket, _ in ROLLUPS:
+        src, dest = f"guild:{guild_id}:{source}", f"guild:{guild_id}:{rollup}"
+        try:
+            info = await client.ts().info(dest)
+        except ResponseError:
+            continue
+        if info.first_timestamp:
+            # up to the end of the first compacted bucket
+            end = info.first_timestamp - info.first_timestamp % bucket + bucket - 1
+        else:
+            # nothing compacted yet, the open bucket is still the rule's
+            now = int(time.time() * 1000)
+            end = now - now % bucket - 1
+        buckets = await client.ts().range(
+            src, "-", end, aggregation_type=aggregation, bucket_size_msec=bucket
+        )
+        for i in range(0, len(buckets), 1000):
+            async with client.pipeline(transaction=False) as pipe:
+                for ts, value in buckets[i : i + 1000]:
+                    # replaces the partial bucket the rule wrote
+                    pipe.execute_command("TS.ADD", dest, ts, value, "ON_DUPLICATE", "LAST")
+                await pipe.execute()
+        count += len(buckets)
+
+    if raw_retention:
+        async with client.pipeline(transaction=False) as pipe:
+            for source in {source for source, *_ in ROLLUPS}:
+                pipe.execute_command(
+                    "TS.ALTER", f"guild:{guild_id}:{source}", "RETENTION", raw_retention
+                )
+            await pipe.execute()
+    return count
+
+
+async def derive_join_type_series(
+    client: redis.Redis, guild_id: int, join_types: List[str], *, chunk: int = 5000
+) -> int:
+    """Re-derive the per-join-type counter series from the raw sources data
+
+    Only samples older than the first live counter of a direction are
+    replayed, so running it again doesn't count anything twice. Per-code
+    series can't be derived, the raw series don't record the code.
+    """
+    count = 0
+    for source, direction in (("sources", "join"), ("sources.leave", "leave")):
+        keys = [f"guild:{guild_id}:type:{direction}:{name}" for name in join_types]
+        cutoff = int(time.time() * 1000)
+        for key in keys:
+            try:
+                info = await client.ts().info(key)
+            except ResponseError:
+                continue
+            if info.first_timestamp:
+                cutoff = min(cutoff, info.first_timestamp)
+
+        start = 0
+        while True:
+            try:
+                samples = await client.execute_command(
+                    "TS.RANGE", f"guild:{guild_id}:{source}", start, cutoff - 1, "COUNT", chunk
+                )
+            except ResponseError:
+                break
+            if not samples:
+                break
+            async with client.pipeline(transaction=False) as pipe:
+                for ts, value in samples:
+                    join_type = join_types[int(float(value))]
+                    pipe.execute_command(
+                        "TS.ADD",
+                        f"guild:{guild_id}:type:{direction}:{join_type}",
+                        ts,
+                        1,
+                        "RETENTION",
+                        RETENTION,
+                        "ON_DUPLICATE",
+                        "SUM",
+                        "LABELS",
+                        "guild",
+                        guild_id,
+                        "type",
+                        "join_type",
+                        "direction",
+                        direction,
+                        "join_type",
+                        join_type,
+                    )
+                await pipe.execute()
+            count += len(samples)
+            if len(samples) < chunk:
+                break
+            start = int(samples[-1][0]) + 1
+    return count
+
+
+async def migrate_inviter_counters(client: redis.Redis, *, batch: int = 500) -> int:
+    """Move the old guild:{id}:invites:{inviter} INCR keys into the leaderboards
+
+    Counts are added to whatever the live leaderboard already holds and each
+    old key is removed in the same transaction, so the job can be rerun.
+    """
+    count = 0
+    keys: List[str] = []
+
+    async def flush() -> int:
+        values = await client.mget(keys)
+        async with client.pipeline(transaction=True) as pipe:
+            for key, value in zip(keys, values):
+                _, guild_id, _, inviter = key.split(":")
+                if value and int(value) > 0:
+                    pipe.zincrby(leaderboard.board_key(int(guild_id), "inviters"), int(value), inviter)
+                pipe.unlink(key)
+            await pipe.execute()
+        moved = sum(1 for value in values if value and int(value) > 0)
+        keys.clear()
+        return moved
+
+    async for key in client.scan_iter(match="guild:*:invites:*", count=batch):
+        if key.count(":") != 3:
+            continue
+        keys.append(key)
+        if len(keys) >= batch:
+            count += await flush()
+    if keys:
+        count += await flush()
+    return count
+
+
+async def _day_counts(client: redis.Redis, guild_id: int, name: str, source: str, today: int):
+    # closed days come from the daily rollup, today only exists in the raw series
+    counts: Dict[int, int] = {}
+    for key, start, aggregation in (
+        # the rollup already holds one count per day, adding them keeps it
+        (f"guild:{guild_id}:{name}:1d", (today - STATS_DAYS + 1) * DAY, "sum"),
+        (f"guild:{guild_id}:{source}", today * DAY, "count"),
+    ):
+        try:
+            buckets = await client.ts().range(
+                key, start, "+", aggregation_type=aggregation, bucket_size_msec=DAY
+            )
+        except ResponseError:
+            continue
+        for ts, value in buckets:
+            counts[ts // DAY] = int(float(value))
+    return counts
+
+
+async def rebuild_stats(client: redis.Redis, guild_id: int) -> Dict[str, Dict[str, str]]:
+    """Recompute the guild:{id}:stats hash from the series and the member index
+
+    Returns the previous and the rebuilt hash, so the incremental one can be
+    checked against history.
+    """
+    key = f"guild:{guild_id}:stats"
+    today = int(time.time() * 1000) // DAY
+    stats: Dict[str, str] = {"day": str(today)}
+
+    for name, source in (("joins", "sources"), ("leaves", "sources.leave")):
+        counts = await _day_counts(client, guild_id, name, source, today)
+        for day, count in counts.items():
+            stats[f"{name}:{day}"] = str(count)
+        stats[name] = str(sum(counts.values()))
+
+    try:
+        members = int(float((await client.ts().get(f"guild:{guild_id}:members"))[1]))
+    except (ResponseError, TypeError):
+        members = 0
+    joins, leaves = int(stats["joins"]), int(stats["leaves"])
+    stats["members"] = str(members)
+    stats["members:past"] = str(max(members - joins + leaves, 0))
+    churn = leaves * 100 / (members + leaves) if members + leaves else 0
+    stats["churn"] = f"{churn:.2f}"
+
+    index = Member.Meta.index_name
+    # backfilled documents were never counted by the join script
+    query = f"@guild:[{guild_id} {guild_id}] -@join_type:{{NotTracked}}"
+    reply = await client.execute_command(
+        "FT.AGGREGATE", index, query, "GROUPBY", 1, "@join_type", "REDUCE", "COUNT", 0, "AS", "count"
+    )
+    sources = {}
+    for row in reply[1:]:
+        row = dict(zip(row[::2], row[1::2]))
+        sources[row["join_type"]] = int(row["count"])
+        stats[f"source:{row['join_type']}"] = row["count"]
+    if sources:
+        top = max(sources, key=sources.get)
+        stats["top_source"], stats["top_source:count"] = top, str(sources[top])
+
+    if top := await client.zrevrange(leaderboard.board_key(guild_id, "codes"), 0, 0, withscores=True):
+        stats["top_invite"], stats["top_invite:uses"] = top[0][0], str(int(top[0][1]))
+
+    reply = await client.execute_command(
+        "FT.SEARCH", index, query, "SORTBY", "ts", "DESC", "LIMIT", 0, 1,
+        "RETURN", 3, "$.join_type", "$.ts", "$.id",
+    )
+    if reply[0]:
+        doc = dict(zip(reply[2][::2], reply[2][1::2]))
+        stats["last_join_type"] = doc["$.join_type"]
+        stats["last_join_ts"] = doc["$.ts"]
+        stats["last_join_member"] = doc["$.id"]
+    stats["updated"] = str(int(time.time() * 1000))
+
+    async with client.pipeline(transaction=True) as pipe:
+        pipe.hgetall(key)
+        pipe.delete(key)
+        pipe.hset(key, mapping=stats)
+        previous, *_ = await pipe.execute()
+    return {"previous": previous, "rebuilt": stats}
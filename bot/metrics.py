@@ -0,0 +1,257 @@
+"""Opt-in instrumentation of listeners, redis and Discord REST
+
+Nothing here is installed unless METRICS is set, the bot then times every
+listener run, counts redis commands and round trips against the listener
+that issued them, and times REST requests per route. Everything is served
+in the Prometheus text format by ``serve`` and summarized by /admin metrics.
+"""
+import asyncio
+import contextvars
+import logging
+import re
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+import redis.asyncio as redis
+from redis.asyncio.client import Pipeline
+
+# listener currently running, redis commands are counted against it
+current: contextvars.ContextVar[str] = contextvars.ContextVar("listener", default="other")
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the quantile"""
+        rank, seen = q * self.count, 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return 0.0
+
+
+def quantile(values: Iterable[float], q: float) -> float:
+    """Quantile of raw samples, for the windows other modules keep"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.counters: Dict[str, Counter] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        # counters kept elsewhere, read with their label when rendered
+        self.collected: Dict[str, Tuple[str, Callable[[], Mapping[str, float]]]] = {}
+        # seconds of listener time per guild, only the busiest are exported
+        self.guild_time: Counter = Counter()
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(labels.items())
+        series = self.histograms.setdefault(name, {})
+        if (histogram := series.get(key)) is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        self.counters.setdefault(name, Counter())[tuple(labels.items())] += value
+
+    def gauge(self, name: str, read: Callable[[], float]) -> None:
+        self.gauges[name] = read
+
+    def collect(self, name: str, label: str, read: Callable[[], Mapping[str, float]]) -> None:
+        self.collected[name] = (label, read)
+
+    def render(self) -> str:
+        lines: List[str] = []
+
+        def fmt(labels: Iterable[Tuple[str, str]]) -> str:
+            labels = list(labels)
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+        for name, series in self.histograms.items():
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append(f"{name}_bucket{fmt(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{fmt(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{fmt(labels)} {histogram.count}")
+        for name, counter in self.counters.items():
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in counter.items():
+                lines.append(f"{name}{fmt(labels)} {value}")
+        for name, (label, read) in self.collected.items():
+            lines.append(f"# TYPE {name} counter")
+            for value, count in read().items():
+                lines.append(f"{name}{fmt(((label, value),))} {count}")
+        for name, read in self.gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {read()}")
+        lines.append("# TYPE guild_listener_seconds counter")
+        for guild_id, seconds in self.guild_time.most_common(10):
+            lines.append(f'guild_listener_seconds{{guild="{guild_id}"}} {seconds}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def attributed(name: str):
+    """Count redis commands of tasks started in this block against ``name``"""
+    token = current.set(name)
+    try:
+        yield
+    finally:
+        current.reset(token)
+
+
+def guild_of(args) -> Optional[int]:
+    """Guild id of a listener call, from the member, invite, role or guild argument"""
+    if not args:
+        return None
+    arg = args[0]
+    guild = getattr(arg, "guild", None)
+    if guild is not None:
+        return guild.id
+    return getattr(arg, "id", None) if type(arg).__name__ == "Guild" else None
+
+
+async def timed_listener(coro, name: str, args) -> None:
+    token = current.set(name)
+    start = time.perf_counter()
+    try:
+        await coro
+    finally:
+        elapsed = time.perf_counter() - start
+        current.reset(token)
+        metrics.observe("listener_seconds", elapsed, listener=name)
+        if (guild_id := guild_of(args)) is not None:
+            metrics.guild_time[guild_id] += elapsed
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        commands = len(self.command_stack)
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            listener = current.get()
+            metrics.observe("redis_roundtrip_seconds", time.perf_counter() - start, listener=listener)
+            metrics.inc("redis_commands_total", commands, listener=listener)
+
+
+class InstrumentedRedis(redis.Redis):
+    """Redis client counting commands and round trips per listener"""
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            listener = current.get()
+            metrics.observe("redis_roundtrip_seconds", time.perf_counter() - start, listener=listener)
+            metrics.inc("redis_commands_total", 1, listener=listener)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+def instrument_http(http) -> None:
+    """Time every REST request by its route template"""
+    request = http.request
+
+    async def timed_request(route, **kwargs):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await request(route, **kwargs)
+            status = "ok"
+            return response
+        except Exception as e:
+            status = type(e).__name__
+            raise
+        finally:
+            labels = {"method": route.method, "route": route.path}
+            metrics.observe("rest_seconds", time.perf_counter() - start, **labels)
+            metrics.inc("rest_requests_total", 1, status=status, **labels)
+
+    http.request = timed_request
+
+
+class RateLimitFilter(logging.Filter):
+    """Add up the waits discord.http logs, letting through what its level would
+
+    discord.py only reports bucket waits as debug records, so the logger is
+    lowered to DEBUG and this filter drops them again before any handler.
+    """
+
+    pattern = re.compile(r"[Rr]etrying in ([\d.]+) seconds")
+
+    def __init__(self, level: int):
+        super().__init__()
+        self.level = level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if isinstance(record.msg, str) and "etrying in" in record.msg and (match := self.pattern.search(record.getMessage())):
+            metrics.inc("rest_ratelimit_seconds_total", float(match.group(1)))
+            metrics.inc("rest_ratelimited_total")
+        return record.levelno >= self.level
+
+
+def instrument_ratelimits() -> None:
+    logger = logging.getLogger("discord.http")
+    logger.addFilter(RateLimitFilter(logger.getEffectiveLevel()))
+    logger.setLevel(logging.DEBUG)
+
+
+async def loop_lag(interval: float = 0.5) -> None:
+    """Measure how late the event loop wakes up, a busy handler shows up here"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        metrics.observe("event_loop_lag_seconds", time.perf_counter() - start - interval)
+
+
+async def serve(host: str, port: int):
+    # aiohttp comes with discord.py, only needed when metrics are served
+    from aiohttp import web
+
+    async def handler(_request):
+        return web.Response(text=metrics.render(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
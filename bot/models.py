@@ -2,42 +2,66 @@ from aredis_om import Field, JsonModel
 from pydantic import PositiveInt
 from typing import List, Optional
 import datetime
+import os
+
+# fields each profile indexes, None indexes everything
+INDEX_PROFILES = {
+    "full": None,
+    # only what the dashboard filters and sorts by and the handlers query
+    "lean": {
+        "guild",
+        "guild_id",
+        "join_type",
+        "ts",
+        "inviter",
+        "code_used",
+        "display_name",
+        "created_at",
+    },
+}
+INDEX_PROFILE = os.getenv("INDEX_PROFILE", "lean")
+
+
+def indexed(field: str) -> bool:
+    fields = INDEX_PROFILES[INDEX_PROFILE]
+    return fields is None or field in fields
+
 
 class Member(JsonModel):
-    display_name: str = Field(index=True)
-    username: str = Field(index=True)
-    avatar: str = Field(index=True)
+    display_name: str = Field(index=indexed("display_name"))
+    username: str = Field(index=indexed("username"))
+    avatar: str = Field(index=indexed("avatar"))
     # created_at: datetime
-    created_at: datetime.date = Field(index=True)
-    id: PositiveInt = Field(index=True)
-    guild: PositiveInt = Field(index=True)
-    joined_at: datetime.date = Field(index=True)
-    join_type: str = Field(index=True)
-    ts: int = Field(index=True)
-    inviter: Optional[PositiveInt] = Field(index=True)
-    code_used: Optional[str] = Field(index=True)
+    created_at: datetime.date = Field(index=indexed("created_at"))
+    id: PositiveInt = Field(index=indexed("id"))
+    guild: PositiveInt = Field(index=indexed("guild"))
+    joined_at: datetime.date = Field(index=indexed("joined_at"))
+    join_type: str = Field(index=indexed("join_type"))
+    ts: int = Field(index=indexed("ts"))
+    inviter: Optional[PositiveInt] = Field(index=indexed("inviter"))
+    code_used: Optional[str] = Field(index=indexed("code_used"))
     
 class Role(JsonModel):
     class Meta:
         global_key_prefix = "role"
-    id: PositiveInt = Field(index=True, primary_key=True)
-    guild_id: PositiveInt = Field(index=True)
-    name: str = Field(index=True)
-    color: int = Field(index=True)
-    position: int = Field(index=True)
-    permissions: int = Field(index=True)
-    hoist: bool = Field(index=True)
-    managed: bool = Field(index=True)
-    mentionable: bool = Field(index=True)
+    id: PositiveInt = Field(index=indexed("id"), primary_key=True)
+    guild_id: PositiveInt = Field(index=indexed("guild_id"))
+    name: str = Field(index=indexed("name"))
+    color: int = Field(index=indexed("color"))
+    position: int = Field(index=indexed("position"))
+    permissions: int = Field(index=indexed("permissions"))
+    hoist: bool = Field(index=indexed("hoist"))
+    managed: bool = Field(index=indexed("managed"))
+    mentionable: bool = Field(index=indexed("mentionable"))
 
 class Guild(JsonModel):
-    id: PositiveInt = Field(index=True)
-    name: str = Field(index=True)
-    icon: str = Field(index=True)
-    owner: PositiveInt = Field(index=True)
-    region: str = Field(index=True)
-    afk_timeout: int = Field(index=True)
-    afk_channel_id: Optional[PositiveInt] = Field(index=True)
-    verification_level: int = Field(index=True)
-    default_message_notifications: int = Field(index=True)
-    explicit_content_filter: int = Field(index=True)
\ No newline at end of file
+    id: PositiveInt = Field(index=indexed("id"))
+    name: str = Field(index=indexed("name"))
+    icon: str = Field(index=indexed("icon"))
+    owner: PositiveInt = Field(index=indexed("owner"))
+    region: str = Field(index=indexed("region"))
+    afk_timeout: int = Field(index=indexed("afk_timeout"))
+    afk_channel_id: Optional[PositiveInt] = Field(index=indexed("afk_channel_id"))
+    verification_level: int = Field(index=indexed("verification_level"))
+    default_message_notifications: int = Field(index=indexed("default_message_notifications"))
+    explicit_content_filter: int = Field(index=indexed("explicit_content_filter"))
\ No newline at end of file
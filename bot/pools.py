@@ -0,0 +1,181 @@
+"""Separately sized redis pools and a client-side cache for rarely changing keys"""
+import asyncio
+import time
+import weakref
+from collections import OrderedDict
+from logging import getLogger
+from typing import Any, Dict, Iterable, Optional, Set
+
+import redis.asyncio as redis
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+
+class TimedPool(redis.BlockingConnectionPool):
+    """Blocking pool that adds up how long callers waited for a connection
+
+    Once ``max_connections`` are checked out callers queue for up to
+    ``timeout`` seconds, so bulk jobs on their own pool can't starve the
+    handlers of connections.
+    """
+
+    def __init__(self, name: str, **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+
+    async def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().get_connection(*args, **kwargs)
+        finally:
+            waited = time.perf_counter() - start
+            self.waits += 1
+            self.wait_seconds += waited
+            self.max_wait = max(self.max_wait, waited)
+
+
+class ClientCache:
+    """Values of tracked keys kept in process until redis invalidates them
+
+    Reads go through a small pool whose connections all have CLIENT TRACKING
+    on, the server then remembers which keys they read and publishes their
+    names on ``__redis__:invalidate`` to the listening connection as soon as
+    anyone changes them. Everything is RESP2, tracking uses REDIRECT.
+    """
+
+    channel = "__redis__:invalidate"
+
+    def __init__(
+        self,
+        connection_kwargs: Dict[str, Any],
+        *,
+        maxsize: int = 10000,
+        connections: int = 4,
+        timeout: float = 5,
+    ):
+        self.connection_kwargs = connection_kwargs
+        self.maxsize = maxsize
+        self.connections = connections
+        self.timeout = timeout
+        self.values: "OrderedDict[str, Dict[tuple, Any]]" = OrderedDict()
+        # keys being read right now, and those of them invalidated meanwhile
+        self.inflight: Dict[str, int] = {}
+        self.stale: Set[str] = set()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.redirect: Optional[int] = None
+        self.reader: Optional[redis.Redis] = None
+        self.listener: Optional[redis.Redis] = None
+        self.pubsub = None
+        # reader connections that were tracked before
+        self.tracked: "weakref.WeakSet" = weakref.WeakSet()
+        self.log = getLogger("discord.app").getChild(type(self).__name__)
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    async def _track(self, connection) -> None:
+        # runs on every (re)connect of a reader connection, tracking is per connection
+        await connection.on_connect()
+        await connection.send_command("CLIENT", "TRACKING", "ON", "REDIRECT", self.redirect)
+        await connection.read_response()
+        if connection in self.tracked:
+            # the keys it read before the drop aren't tracked anymore
+            self.values.clear()
+        self.tracked.add(connection)
+
+    async def _subscribe(self) -> None:
+        self.pubsub = self.listener.pubsub()
+        await self.pubsub.connect()
+        await self.pubsub.connection.send_command("CLIENT", "ID")
+        self.redirect = int(await self.pubsub.connection.read_response())
+        await self.pubsub.subscribe(self.channel)
+
+    async def start(self) -> None:
+        self.listener = redis.Redis(**self.connection_kwargs)
+        await self._subscribe()
+        self.reader = redis.Redis(
+            connection_pool=TimedPool(
+                "cache",
+                max_connections=self.connections,
+                timeout=self.timeout,
+                redis_connect_func=self._track,
+                **self.connection_kwargs,
+            )
+        )
+        self._task = asyncio.create_task(self._listen())
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async for message in self.pubsub.listen():
+                    if message["type"] == "message":
+                        self.invalidate(message["data"])
+            except (RedisConnectionError, OSError) as e:
+                # the redirect target is gone, nothing can be trusted anymore
+                self.log.warning("Lost the invalidation channel: %s", e)
+                self.values.clear()
+                await asyncio.sleep(1)
+                try:
+                    await self.pubsub.reset()
+                    await self._subscribe()
+                    # tracking is switched back on by the readers' reconnect
+                    await self.reader.connection_pool.disconnect()
+                except (RedisConnectionError, OSError):
+                    continue
+
+    def invalidate(self, keys: Optional[Iterable[str]]) -> None:
+        if keys is None:
+            # FLUSHDB / FLUSHALL
+            self.values.clear()
+            self.stale.update(self.inflight)
+            return
+        for key in [keys] if isinstance(keys, str) else keys:
+            self.invalidations += 1
+            self.values.pop(key, None)
+            if key in self.inflight:
+                self.stale.add(key)
+
+    async def read(self, command: str, key: str, *args) -> Any:
+        """Run a read only command on a single key, from the cache when possible"""
+        if self.reader is None:
+            raise RuntimeError("client cache not started")
+        entry = self.values.get(key)
+        if entry is not None and (command, args) in entry:
+            self.values.move_to_end(key)
+            self.hits += 1
+            return entry[command, args]
+
+        self.misses += 1
+        self.inflight[key] = self.inflight.get(key, 0) + 1
+        try:
+            value = await self.reader.execute_command(command, key, *args)
+        finally:
+            if (count := self.inflight.pop(key) - 1) > 0:
+                self.inflight[key] = count
+            stale = key in self.stale
+            if not count:
+                self.stale.discard(key)
+        if not stale:
+            self.values.setdefault(key, {})[command, args] = value
+            self.values.move_to_end(key)
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+        return value
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.values.clear()
+        if self.pubsub is not None:
+            await self.pubsub.reset()
+        for client in (self.reader, self.listener):
+            if client is not None:
+                await client.close()
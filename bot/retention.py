@@ -0,0 +1,76 @@
+"""Time-to-leave histograms and weekly join cohorts, updated by the join and leave scripts
+
+Every guild has one histogram hash, ``guild:{id}:retention:hist``, counting
+leaves per lifetime bucket, and one hash per join week,
+``guild:{id}:cohort:{week}``, with the fields
+
+- ``joined:{join_type}`` / ``joined:code:{code}``, members joined that week
+- ``left:{join_type}:{n}`` / ``left:code:{code}:{n}``, of those, how many left
+  in their n-th week, capped at ``COHORT_WEEKS``
+
+so a curve is read from the cohort hashes alone. Cohorts expire once they
+are older than ``COHORT_WEEKS``, which bounds the storage per guild.
+"""
+from typing import Dict, List, Optional
+
+import redis.asyncio as redis
+
+WEEK = 7 * 86400
+COHORT_WEEKS = 26
+COHORT_TTL = (COHORT_WEEKS + 1) * WEEK
+# lower edges of the lifetime buckets in days, the last one is open ended
+HISTOGRAM_DAYS = [0, 1, 2, 3, 7, 14, 30, 60, 90, 180, 365]
+
+
+def histogram_key(guild_id: int) -> str:
+    return f"guild:{guild_id}:retention:hist"
+
+
+def cohort_key(guild_id: int, week: int) -> str:
+    return f"guild:{guild_id}:cohort:{week}"
+
+
+async def histogram(client: redis.Redis, guild_id: int) -> Dict[str, int]:
+    """Leaves per lifetime bucket, in bucket order"""
+    counts = await client.hgetall(histogram_key(guild_id))
+    return {
+        label: int(counts.get(label, 0))
+        for label in (f"{days}d" for days in HISTOGRAM_DAYS)
+    }
+
+
+def cohort_curve(cohort: Dict[str, str], group: str, weeks: int) -> Optional[List[float]]:
+    """Share of a cohort still in the guild after each of its first weeks"""
+    joined = int(cohort.get(f"joined:{group}", 0))
+    if not joined:
+        return None
+    remaining, curve = joined, []
+    for n in range(weeks):
+        remaining -= int(cohort.get(f"left:{group}:{n}", 0))
+        curve.append(max(remaining, 0) / joined)
+    return curve
+
+
+async def curves(
+    client: redis.Redis,
+    guild_id: int,
+    this_week: int,
+    *,
+    group: str,
+    cohorts: int = 8,
+) -> Dict[int, List[float]]:
+    """Retention curves of the last weekly cohorts for a join type or ``code:{code}``
+
+    A cohort's curve stops at the current week, later points aren't known yet.
+    """
+    weeks = list(range(this_week - cohorts + 1, this_week + 1))
+    async with client.pipeline(transaction=False) as pipe:
+        for week in weeks:
+            pipe.hgetall(cohort_key(guild_id, week))
+        hashes = await pipe.execute()
+    result = {}
+    for week, cohort in zip(weeks, hashes):
+        curve = cohort_curve(cohort, group, min(this_week - week + 1, COHORT_WEEKS))
+        if curve is not None:
+            result[week] = curve
+    return result
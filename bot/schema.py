@@ -0,0 +1,143 @@
+from logging import getLogger
+from typing import Callable, Iterable, List, Set
+
+import redis.asyncio as redis
+from redis.exceptions import ResponseError
+
+# 8 weeks
+RETENTION = 4838400000
+HOUR = 3600000
+DAY = 86400000
+
+# (source, rollup, aggregation, bucket, retention)
+ROLLUPS = [
+    ("members", "members:1h", "avg", HOUR, 90 * DAY),
+    ("members", "members:1d", "avg", DAY, 730 * DAY),
+    ("sources", "joins:1h", "count", HOUR, 90 * DAY),
+    ("sources", "joins:1d", "count", DAY, 730 * DAY),
+    ("sources.leave", "leaves:1h", "count", HOUR, 90 * DAY),
+    ("sources.leave", "leaves:1d", "count", DAY, 730 * DAY),
+]
+
+
+def create_series(pipe, guild_id: int, name: str, *, retention: int = RETENTION):
+    pipe.execute_command(
+        "TS.CREATE",
+        f"guild:{guild_id}:{name}",
+        "RETENTION",
+        retention,
+        "LABELS",
+        "guild",
+        str(guild_id),
+        "type",
+        name,
+    )
+
+
+def initial_series(pipe, guild_id: int) -> None:
+    # member count, the join method and the leave method
+    for name in ["members", "sources", "sources.leave", "retention"]:
+        create_series(pipe, guild_id, name)
+
+
+def last_member_count_wins(pipe, guild_id: int) -> None:
+    # two member counts for the same millisecond should keep the latest
+    pipe.execute_command(
+        "TS.ALTER", f"guild:{guild_id}:members", "DUPLICATE_POLICY", "LAST"
+    )
+
+
+def rollup_series(pipe, guild_id: int) -> None:
+    # downsampled copies the dashboard reads instead of the raw samples
+    for source, rollup, aggregation, bucket, retention in ROLLUPS:
+        create_series(pipe, guild_id, rollup, retention=retention)
+        pipe.execute_command(
+            "TS.CREATERULE",
+            f"guild:{guild_id}:{source}",
+            f"guild:{guild_id}:{rollup}",
+            "AGGREGATION",
+            aggregation,
+            bucket,
+        )
+
+
+# every step moves a guild one version forward, append only
+MIGRATIONS: List[Callable] = [
+    initial_series,
+    last_member_count_wins,
+    rollup_series,
+]
+VERSION = len(MIGRATIONS)
+
+
+def _ignorable(error: Exception) -> bool:
+    # guilds created before versioning already have their series
+    return isinstance(error, ResponseError) and (
+        "already exists" in str(error) or "already has" in str(error)
+    )
+
+
+class GuildSchema:
+    """Versioned per-guild redis layout
+
+    The version of every guild lives in one hash so checking a whole fleet
+    costs a single HMGET, and only guilds behind ``VERSION`` get the missing
+    migration steps, all pipelined together.
+    """
+
+    key = "schema:guilds"
+
+    def __init__(self, client: redis.Redis, *, batch: int = 500):
+        self.redis = client
+        self.batch = batch
+        self.current: Set[int] = set()
+        self.log = getLogger("discord.app").getChild(type(self).__name__)
+
+    async def bootstrap(self, guild_ids: Iterable[int]) -> int:
+        """Bring guilds up to date, returns how many needed migrating"""
+        ids = [i for i in dict.fromkeys(guild_ids) if i not in self.current]
+        if not ids:
+            return 0
+
+        versions = await self.redis.hmget(self.key, ids)
+        stale = []
+        for guild_id, version in zip(ids, versions):
+            version = int(version or 0)
+            if version >= VERSION:
+                self.current.add(guild_id)
+            else:
+                stale.append((guild_id, version))
+
+        for i in range(0, len(stale), self.batch):
+            await self._migrate(stale[i : i + self.batch])
+        return len(stale)
+
+    async def _migrate(self, stale) -> None:
+        spans = []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for guild_id, version in stale:
+                start = len(pipe.command_stack)
+                for step in MIGRATIONS[version:]:
+                    step(pipe, guild_id)
+                spans.append((guild_id, start, len(pipe.command_stack)))
+            results = await pipe.execute(raise_on_error=False)
+
+        upgraded = {}
+        for guild_id, start, end in spans:
+            errors = [
+                r
+                for r in results[start:end]
+                if isinstance(r, Exception) and not _ignorable(r)
+            ]
+            if errors:
+                self.log.error("Failed to migrate guild %s: %s", guild_id, errors[0])
+            else:
+                upgraded[guild_id] = VERSION
+
+        if upgraded:
+            await self.redis.hset(self.key, mapping=upgraded)
+            self.current.update(upgraded)
+        self.log.info("Migrated %s/%s guilds to schema v%s", len(upgraded), len(stale), VERSION)
+
+    def forget(self, guild_id: int) -> None:
+        self.current.discard(guild_id)
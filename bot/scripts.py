@@ -0,0 +1,314 @@
+"""Server-side scripts committing a join or a leave in a single round trip"""
+import hashlib
+
+import retention
+
+# length of the rolling window of the stats hash
+STATS_DAYS = 30
+
+
+class LuaScript:
+    def __init__(self, source: str):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+
+# appends to a series, moving the sample forward if its millisecond is taken
+_TS_ADD = """
+local function ts_add(key, ts, value)
+  local last = redis.pcall('TS.GET', key)
+  if type(last) == 'table' and last[1] and tonumber(last[1]) >= ts then
+    ts = tonumber(last[1]) + 1
+  end
+  return redis.call('TS.ADD', key, ts, value)
+end
+"""
+
+# one counter series per guild, direction and join type (or linked invite
+# code), labeled so breakdowns are a single TS.MRANGE ... GROUPBY. The keys
+# are derived inside the script, fine on a single redis instance.
+_COUNT = """
+local function count(key, ts, retention, ...)
+  return redis.call(
+    'TS.ADD', key, ts, 1, 'RETENTION', retention, 'ON_DUPLICATE', 'SUM', 'LABELS', ...
+  )
+end
+local function count_type(guild, direction, join_type, ts, retention)
+  count(
+    'guild:' .. guild .. ':type:' .. direction .. ':' .. join_type, ts, retention,
+    'guild', guild, 'type', 'join_type', 'direction', direction, 'join_type', join_type
+  )
+end
+local function count_code(guild, direction, code, ts, retention)
+  if code and code ~= '' and redis.call('HEXISTS', code, 'name') == 1 then
+    count(
+      'guild:' .. guild .. ':code:' .. direction .. ':' .. code, ts, retention,
+      'guild', guild, 'type', 'code', 'direction', direction, 'code', code
+    )
+  end
+end
+"""
+
+# sorted set leaderboards, the all-time board plus one bucket per day that
+# expires once it falls out of every rolling window
+_CREDIT = """
+local function credit(board, member, day, ttl, by)
+  if not member or member == '' or member == '1' then
+    return
+  end
+  if tonumber(redis.call('ZINCRBY', board, by, member)) <= 0 then
+    redis.call('ZREM', board, member)
+  end
+  local bucket = board .. ':' .. day
+  if by > 0 then
+    redis.call('ZINCRBY', bucket, by, member)
+    redis.call('EXPIRE', bucket, ttl)
+  elseif redis.call('EXISTS', bucket) == 1 then
+    if tonumber(redis.call('ZINCRBY', bucket, by, member)) <= 0 then
+      redis.call('ZREM', bucket, member)
+    end
+  end
+end
+"""
+
+# lifetime histogram and weekly cohorts, see retention.py
+_RETENTION = """
+local HISTOGRAM_DAYS = {%s}
+local WEEK = %d
+local COHORT_WEEKS = %d
+local function cohort_key(guild, week)
+  return 'guild:' .. guild .. ':cohort:' .. week
+end
+local function cohort_join(guild, week, ttl, join_type, code)
+  local key = cohort_key(guild, week)
+  redis.call('HINCRBY', key, 'joined:' .. join_type, 1)
+  if code and code ~= '' then
+    redis.call('HINCRBY', key, 'joined:code:' .. code, 1)
+  end
+  redis.call('EXPIRE', key, ttl)
+end
+local function cohort_leave(guild, joined, now, join_type, code)
+  local lifetime = math.max(now - joined, 0)
+  local days = math.floor(lifetime / 86400)
+  local label = '0d'
+  for _, edge in ipairs(HISTOGRAM_DAYS) do
+    if days >= edge then
+      label = edge .. 'd'
+    end
+  end
+  redis.call('HINCRBY', 'guild:' .. guild .. ':retention:hist', label, 1)
+  -- members who joined before the cohorts existed only count in the histogram
+  local key = cohort_key(guild, math.floor(joined / WEEK))
+  if redis.call('HEXISTS', key, 'joined:' .. join_type) == 1 then
+    local n = math.min(math.floor(lifetime / WEEK), COHORT_WEEKS)
+    redis.call('HINCRBY', key, 'left:' .. join_type .. ':' .. n, 1)
+    if code and redis.call('HEXISTS', key, 'joined:code:' .. code) == 1 then
+      redis.call('HINCRBY', key, 'left:code:' .. code .. ':' .. n, 1)
+    end
+  end
+  return lifetime
+end
+""" % (
+    ", ".join(map(str, retention.HISTOGRAM_DAYS)),
+    retention.WEEK,
+    retention.COHORT_WEEKS,
+)
+
+# the materialized guild:{id}:stats hash the dashboard reads: day counters
+# for the rolling window, rolled forward when the day changes, plus the
+# derived member count, churn and top source / invite
+_STATS = """
+local STATS_DAYS = %d
+local function stats_key(guild)
+  return 'guild:' .. guild .. ':stats'
+end
+local function stats_roll(key, today)
+  local last = tonumber(redis.call('HGET', key, 'day'))
+  if last and last >= today then
+    return
+  end
+  redis.call('HSET', key, 'day', today)
+  if not last then
+    return
+  end
+  for d = last - STATS_DAYS + 1, math.min(last, today - STATS_DAYS) do
+    for _, name in ipairs({'joins', 'leaves'}) do
+      local n = tonumber(redis.call('HGET', key, name .. ':' .. d))
+      if n then
+        redis.call('HINCRBY', key, name, -n)
+        redis.call('HDEL', key, name .. ':' .. d)
+      end
+    end
+  end
+end
+local function stats_source(key, join_type, by)
+  local n = redis.call('HINCRBY', key, 'source:' .. join_type, by)
+  if n < 0 then
+    -- the member joined before the stats existed
+    n = 0
+    redis.call('HSET', key, 'source:' .. join_type, 0)
+  end
+  local top = redis.call('HGET', key, 'top_source')
+  if top == join_type or not top then
+    redis.call('HSET', key, 'top_source', join_type, 'top_source:count', n)
+  elseif by > 0 and n > tonumber(redis.call('HGET', key, 'top_source:count') or 0) then
+    redis.call('HSET', key, 'top_source', join_type, 'top_source:count', n)
+  end
+  if top == join_type and by < 0 then
+    -- the top source shrank, another one may have overtaken it
+    local fields = redis.call('HGETALL', key)
+    for i = 1, #fields, 2 do
+      local name = string.match(fields[i], '^source:(.+)$')
+      if name and tonumber(fields[i + 1]) > n then
+        top, n = name, tonumber(fields[i + 1])
+      end
+    end
+    redis.call('HSET', key, 'top_source', top, 'top_source:count', n)
+  end
+end
+local function stats_top_invite(key, board)
+  local top = redis.call('ZREVRANGE', board, 0, 0, 'WITHSCORES')
+  if top[1] then
+    redis.call('HSET', key, 'top_invite', top[1], 'top_invite:uses', top[2])
+  else
+    redis.call('HDEL', key, 'top_invite', 'top_invite:uses')
+  end
+end
+local function stats_event(guild, name, now, member_count)
+  local key = stats_key(guild)
+  local today = math.floor(now / 86400000)
+  stats_roll(key, today)
+  redis.call('HINCRBY', key, name .. ':' .. today, 1)
+  redis.call('HINCRBY', key, name, 1)
+  if member_count ~= '' then
+    redis.call('HSET', key, 'members', member_count)
+  end
+  local members = tonumber(redis.call('HGET', key, 'members') or 0)
+  local joins = tonumber(redis.call('HGET', key, 'joins') or 0)
+  local leaves = tonumber(redis.call('HGET', key, 'leaves') or 0)
+  -- leaves over everyone who was a member at some point in the window
+  local churn = 0
+  if members + leaves > 0 then
+    churn = leaves * 100 / (members + leaves)
+  end
+  redis.call(
+    'HSET', key,
+    'members:past', math.max(members - joins + leaves, 0),
+    'churn', string.format('%%.2f', churn),
+    'updated', now
+  )
+  return key
+end
+""" % STATS_DAYS
+
+# KEYS: members series, sources series, joins set, member document,
+#       member pk hash, inviter leaderboard ('' if none), errors set,
+#       linked roles set of the code ('' if none), code leaderboard ('' if none)
+# ARGV: now (ms), member count ('' if unknown), join type value, member id,
+#       member json, member pk, error to clear, join type name, guild id,
+#       invite code ('' if none), counter retention, inviter id, day,
+#       leaderboard bucket ttl (s), join week, cohort ttl (s)
+# Returns the roles linked to the invite used.
+JOIN = LuaScript(
+    _TS_ADD
+    + _COUNT
+    + _CREDIT
+    + _RETENTION
+    + _STATS
+    + """
+local now = tonumber(ARGV[1])
+local stats = stats_event(ARGV[9], 'joins', now, ARGV[2])
+stats_source(stats, ARGV[8], 1)
+redis.call(
+  'HSET', stats, 'last_join_type', ARGV[8], 'last_join_ts', math.floor(now / 1000),
+  'last_join_member', ARGV[4]
+)
+if ARGV[2] ~= '' then
+  ts_add(KEYS[1], now, ARGV[2])
+end
+ts_add(KEYS[2], now, ARGV[3])
+cohort_join(ARGV[9], ARGV[15], ARGV[16], ARGV[8], ARGV[10])
+count_type(ARGV[9], 'join', ARGV[8], now, ARGV[11])
+count_code(ARGV[9], 'join', ARGV[10], now, ARGV[11])
+redis.call('SADD', KEYS[3], ARGV[4])
+redis.call('JSON.SET', KEYS[4], '$', ARGV[5])
+redis.call('HSET', KEYS[5], ARGV[4], ARGV[6])
+if KEYS[6] ~= '' then
+  credit(KEYS[6], ARGV[12], ARGV[13], ARGV[14], 1)
+end
+if KEYS[9] ~= '' then
+  credit(KEYS[9], ARGV[10], ARGV[13], ARGV[14], 1)
+  stats_top_invite(stats, KEYS[9])
+end
+redis.call('SREM', KEYS[7], ARGV[7])
+if KEYS[8] ~= '' then
+  return redis.call('SMEMBERS', KEYS[8])
+end
+return {}
+"""
+)
+
+# KEYS: member pk hash, joins set, members series, sources.leave series,
+#       retention series
+# ARGV: now (ms), member count ('' if unknown), member id, guild id,
+#       member key prefix, counter retention, then every join type name
+#       ordered by value
+# The leaderboard credit is taken back from the bucket of the join day and
+# the membership lifetime (ms) is added to the retention series.
+# Returns the join type name the member was tracked with.
+LEAVE = LuaScript(
+    _TS_ADD
+    + _COUNT
+    + _CREDIT
+    + _RETENTION
+    + _STATS
+    + """
+local now = tonumber(ARGV[1])
+local join_type, inviter, code, joined = 'NotTracked', nil, nil, nil
+local pk = redis.call('HGET', KEYS[1], ARGV[3])
+if pk then
+  local key = ARGV[5] .. pk
+  local stored = redis.call('JSON.GET', key, '$.join_type')
+  if stored then
+    join_type = string.match(stored, '"(%w+)"') or join_type
+    -- snowflakes don't fit a lua number, keep them as strings
+    inviter = string.match(redis.call('JSON.GET', key, '$.inviter') or '', '%d+')
+    code = string.match(redis.call('JSON.GET', key, '$.code_used') or '', '"([^"]+)"')
+    joined = tonumber(string.match(redis.call('JSON.GET', key, '$.ts') or '', '%d+'))
+    redis.call('UNLINK', key)
+  end
+  redis.call('HDEL', KEYS[1], ARGV[3])
+end
+redis.call('SREM', KEYS[2], ARGV[3])
+local stats = stats_event(ARGV[4], 'leaves', now, ARGV[2])
+if joined then
+  -- only members the join script saw were counted in the sources
+  if join_type ~= 'NotTracked' then
+    stats_source(stats, join_type, -1)
+  end
+  if join_type == 'Invite' then
+    local board = 'guild:' .. ARGV[4] .. ':lb:'
+    local day = math.floor(joined / 86400)
+    credit(board .. 'inviters', inviter, day, 0, -1)
+    credit(board .. 'codes', code, day, 0, -1)
+    stats_top_invite(stats, board .. 'codes')
+  end
+  local lifetime = cohort_leave(ARGV[4], joined, math.floor(now / 1000), join_type, code)
+  ts_add(KEYS[5], now, lifetime * 1000)
+end
+
+local value = 0
+for i = 7, #ARGV do
+  if ARGV[i] == join_type then
+    value = i - 7
+  end
+end
+if ARGV[2] ~= '' then
+  ts_add(KEYS[3], now, ARGV[2])
+end
+ts_add(KEYS[4], now, value)
+count_type(ARGV[4], 'leave', join_type, now, ARGV[6])
+count_code(ARGV[4], 'leave', code, now, ARGV[6])
+return join_type
+"""
+)
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from logging import getLogger
+from typing import AsyncIterator, Dict, List
+
+import redis.asyncio as redis
+
+from cogs.backfill import MemberBackfill
+from models import Member, Role
+
+
+class Teardown:
+    """Remove everything stored for a guild without blocking redis
+
+    Keys are collected from the guild's own registries (its invite set, the
+    Member and Role indexes) and finally a SCAN over ``guild:{id}:*`` for
+    anything else plus the backfill checkpoint, then UNLINKed in bounded batches capped at ``rate`` keys
+    per second from a background task.
+    """
+
+    def __init__(self, client: redis.Redis, *, batch: int = 500, rate: float = 5000):
+        self.redis = client
+        self.batch = batch
+        self.rate = rate
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.progress: Dict[int, int] = {}
+        self.log = getLogger("discord.app").getChild(type(self).__name__)
+
+    def schedule(self, guild_id: int) -> asyncio.Task:
+        if (task := self.tasks.get(guild_id)) is None or task.done():
+            task = asyncio.create_task(self.run(guild_id))
+            self.tasks[guild_id] = task
+            task.add_done_callback(lambda _: self.tasks.pop(guild_id, None))
+        return task
+
+    async def _search(self, index: str, query: str) -> List[str]:
+        # NOCONTENT only returns the keys, deleted ones drop out of the next page
+        result = await self.redis.execute_command(
+            "FT.SEARCH", index, query, "NOCONTENT", "LIMIT", 0, self.batch
+        )
+        return list(result[1:])
+
+    async def keys(self, guild_id: int) -> AsyncIterator[List[str]]:
+        codes = []
+        async for code in self.redis.sscan_iter(
+            f"guild:{guild_id}:invites", count=self.batch
+        ):
+            codes.extend((code, f"{code}:roles"))
+            if len(codes) >= self.batch:
+                yield codes
+                codes = []
+        if codes:
+            yield codes
+
+        for model, field in ((Member, "guild"), (Role, "guild_id")):
+            query = f"@{field}:[{guild_id} {guild_id}]"
+            previous = None
+            while keys := await self._search(model.Meta.index_name, query):
+                if keys == previous:
+                    break
+                yield keys
+                # a page that didn't change means the index is stale, give up
+                previous = keys
+
+        keys = []
+        async for key in self.redis.scan_iter(
+            match=f"guild:{guild_id}:*", count=self.batch
+        ):
+            keys.append(key)
+            if len(keys) >= self.batch:
+                yield keys
+                keys = []
+        keys.extend((f"guild:{guild_id}", MemberBackfill.checkpoint_key(guild_id)))
+        yield keys
+
+    async def run(self, guild_id: int) -> int:
+        start = time.perf_counter()
+        self.progress[guild_id] = 0
+        try:
+            async for keys in self.keys(guild_id):
+                removed = await self.redis.unlink(*keys)
+                self.progress[guild_id] += removed
+                self.log.debug("Unlinked %s keys of guild %s", self.progress[guild_id], guild_id)
+                await asyncio.sleep(len(keys) / self.rate)
+        finally:
+            removed = self.progress.pop(guild_id, 0)
+        self.log.info(
+            "Tore down guild %s with %s keys in %.2fs",
+            guild_id,
+            removed,
+            time.perf_counter() - start,
+        )
+        return removed
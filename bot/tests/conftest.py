@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the bot runs from its own folder and imports its modules top-level
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,100 @@
+import random
+import time
+
+from cogs.attribution import InviteUses, assign_joins, diff_invites
+
+
+def table(**invites):
+    return {code: InviteUses(*uses) for code, uses in invites.items()}
+
+
+def test_single_invite_used():
+    deltas = diff_invites(table(a=(3, 0), b=(1, 0)), table(a=(4, 0), b=(1, 0)))
+    assert deltas == {"a": 1}
+    assert assign_joins(deltas, 1) == ["a"]
+
+
+def test_multi_code_deltas_cover_every_join():
+    old = table(a=(0, 0), b=(5, 0), c=(2, 0))
+    new = table(a=(2, 0), b=(6, 0), c=(2, 0))
+    deltas = diff_invites(old, new)
+    assert deltas == {"a": 2, "b": 1}
+    # largest delta first, the order doesn't depend on dict order
+    assert assign_joins(deltas, 3) == ["a", "a", "b"]
+    assert assign_joins(dict(reversed(deltas.items())), 3) == ["a", "a", "b"]
+
+
+def test_ties_are_ordered_by_code():
+    assert assign_joins({"b": 1, "a": 1}, 2) == ["a", "b"]
+
+
+def test_invite_vanishing_at_max_uses_counts_once():
+    deltas = diff_invites(table(x=(4, 5), y=(0, 0)), table(y=(0, 0)))
+    assert deltas == {"x": 1}
+    assert assign_joins(deltas, 1) == ["x"]
+
+
+def test_deleted_invite_is_not_a_use():
+    # removed by a moderator two uses away from its limit, or without a limit
+    assert diff_invites(table(x=(3, 5), y=(7, 0)), {}) == {}
+
+
+def test_invite_created_and_used_between_snapshots():
+    assert diff_invites({}, table(new=(1, 0), idle=(0, 0))) == {"new": 1}
+
+
+def test_vanity_and_discovery_joins_have_no_code():
+    # a vanity join doesn't touch the invite table, the cog checks the vanity next
+    deltas = diff_invites(table(a=(1, 0)), table(a=(1, 0)))
+    assert deltas == {}
+    assert assign_joins(deltas, 2) == [None, None]
+
+
+def test_joins_beyond_the_uses_have_no_code():
+    assert assign_joins({"a": 1}, 3) == ["a", None, None]
+
+
+def test_ambiguous_simultaneous_joins():
+    # two codes used but only one of the joins is in this batch
+    assert assign_joins({"a": 1, "b": 1}, 1) == [""]
+    assert assign_joins({"a": 2, "b": 1}, 2) == ["", ""]
+
+
+def test_extra_uses_of_one_code_are_not_ambiguous():
+    # the other join was in an earlier batch, it's still the same invite
+    assert assign_joins({"a": 3}, 1) == ["a"]
+
+
+def test_no_joins():
+    assert assign_joins({"a": 1}, 0) == []
+
+
+def test_large_guild_benchmark():
+    """Diff and assign 10k invites, the size of the biggest guilds' invite tables"""
+    rng = random.Random(0)
+    old = {
+        f"code{i}": InviteUses(rng.randint(0, 1000), rng.choice((0, 0, 0, 1, 100)))
+        for i in range(10000)
+    }
+    new = dict(old)
+    used = rng.sample(sorted(old), 50)
+    for code in used:
+        uses, max_uses = old[code]
+        if max_uses and uses + 1 >= max_uses:
+            del new[code]
+        else:
+            new[code] = InviteUses(uses + 1, max_uses)
+
+    timings = []
+    for _ in range(20):
+        start = time.perf_counter()
+        deltas = diff_invites(old, new)
+        assigned = assign_joins(deltas, len(used))
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+
+    counted = [code for code in used if code in deltas]
+    assert sorted(code for code in assigned if code) == sorted(counted)
+    print(f"\n10k invites: median {timings[10] * 1000:.2f}ms, max {timings[-1] * 1000:.2f}ms")
+    # a join batch window is 500ms, attribution has to stay far below it
+    assert timings[10] < 0.05
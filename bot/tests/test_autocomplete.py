@@ -0,0 +1,81 @@
+import asyncio
+import random
+import string
+
+from cogs.autocomplete import AutocompleteCache, InviteIndex
+
+
+def test_prefix_matches_come_first():
+    index = InviteIndex()
+    index.add("abcdef")
+    index.add("xxabcx")
+    index.add("abzzzz", "Partners")
+    assert index.search("abc") == ["abcdef", "xxabcx"]
+    assert index.search("part") == ["abzzzz"]
+
+
+def test_remove_drops_code_and_name():
+    index = InviteIndex()
+    index.add("abcdef", "Partners")
+    index.remove("abcdef")
+    assert index.search("abc") == []
+    assert index.search("partners") == []
+    assert not index.terms and not index.grams
+
+
+def test_rename_replaces_old_name():
+    index = InviteIndex()
+    index.add("abcdef", "Partners")
+    index.add("abcdef", "Staff")
+    assert index.search("partners") == []
+    assert index.search("staff") == ["abcdef"]
+
+
+def test_cache_evicts_least_recent_guild():
+    built = []
+
+    async def build(guild_id):
+        built.append(guild_id)
+        return {f"code{guild_id}": None}
+
+    async def run():
+        cache = AutocompleteCache(build, capacity=2)
+        await cache.search(1, "")
+        await cache.search(2, "")
+        await cache.search(1, "")
+        await cache.search(3, "")
+        return cache
+
+    cache = asyncio.run(run())
+    assert list(cache.indexes) == [1, 3]
+    assert built == [1, 2, 3]
+
+
+def test_large_guild_p99():
+    """Autocomplete over 10k invites, Discord drops responses after 3 seconds"""
+    rng = random.Random(0)
+    alphabet = string.ascii_letters + string.digits
+    codes = {
+        "".join(rng.choices(alphabet, k=8)): rng.choice((None, f"role {i}"))
+        for i in range(10000)
+    }
+
+    async def build(_guild_id):
+        return codes
+
+    async def run():
+        cache = AutocompleteCache(build)
+        await cache.get(1)
+        cache.latencies.clear()
+        keys = sorted(codes)
+        for _ in range(2000):
+            code = rng.choice(keys)
+            start = rng.randrange(0, 5)
+            query = code[start : start + rng.randint(1, 4)]
+            await cache.search(1, query)
+        return cache
+
+    cache = asyncio.run(run())
+    p99 = cache.percentile(0.99)
+    print(f"\n10k invites: p50 {cache.percentile(0.5) * 1000:.2f}ms, p99 {p99 * 1000:.2f}ms")
+    assert p99 < 0.05
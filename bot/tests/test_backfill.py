@@ -0,0 +1,102 @@
+"""Backfill against a real redis-stack, skipped when there is none
+
+Uses REDIS_HOST, REDIS_PORT and REDIS_OM_URL like the bot, point them at a
+throwaway instance.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip("discord")
+pytest.importorskip("aredis_om")
+redis = pytest.importorskip("redis.asyncio")
+
+from cogs.backfill import MemberBackfill  # noqa: E402
+from indexes import migrate_index  # noqa: E402
+from models import Member  # noqa: E402
+
+GUILD_ID = 9 * 10**18 + 424242
+
+
+class FakeMember:
+    def __init__(self, id: int, guild: "FakeGuild"):
+        self.id = id
+        self.guild = guild
+        self.name = self.display_name = f"user{id}"
+        self.avatar = None
+        self.bot = False
+        self.created_at = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        self.joined_at = datetime.now(timezone.utc)
+
+
+class FakeGuild:
+    def __init__(self, id: int, members: int):
+        self.id = id
+        self.members = [FakeMember(id + i + 1, self) for i in range(members)]
+
+    async def fetch_members(self, *, limit=None, after=None):
+        for member in self.members:
+            if after is None or member.id > after.id:
+                yield member
+
+
+async def connect():
+    client = redis.Redis(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", "6379")),
+        password=os.getenv("REDIS_PASSWORD"),
+        decode_responses=True,
+    )
+    try:
+        await client.ping()
+    except (OSError, redis.ConnectionError):
+        pytest.skip("no redis-stack to backfill into")
+    return client
+
+
+async def cleanup(client, guild: FakeGuild) -> None:
+    pks = await client.hvals(f"guild:{guild.id}:member_pks")
+    keys = [Member.make_key(pk) for pk in pks]
+    await client.delete(
+        *keys,
+        f"guild:{guild.id}:member_pks",
+        f"guild:{guild.id}:joins",
+        MemberBackfill.checkpoint_key(guild.id),
+    )
+
+
+def test_backfilled_members_are_searchable():
+    async def run():
+        client = await connect()
+        guild = FakeGuild(GUILD_ID, 25)
+        await cleanup(client, guild)
+        if (task := await migrate_index(Member)) is not None:
+            await task
+        backfill = MemberBackfill(client, log=logging.getLogger("test"), chunk=10)
+        try:
+            written = await backfill.run(guild)
+            # RediSearch indexes JSON writes synchronously
+            reply = await client.execute_command(
+                "FT.SEARCH",
+                Member.Meta.index_name,
+                f"@guild:[{guild.id} {guild.id}]",
+                "RETURN", 2, "$.id", "$.join_type",
+                "LIMIT", 0, 100,
+            )
+            pk = await client.hget(f"guild:{guild.id}:member_pks", guild.id + 1)
+            stored = await client.execute_command("JSON.TYPE", Member.make_key(pk))
+        finally:
+            await cleanup(client, guild)
+            await client.close()
+        return written, reply, stored
+
+    written, reply, stored = asyncio.run(run())
+    assert written == 25
+    assert stored in ("object", ["object"])
+    assert reply[0] == 25
+    docs = [dict(zip(fields[::2], fields[1::2])) for fields in reply[2::2]]
+    assert {int(doc["$.id"]) for doc in docs} == {GUILD_ID + i + 1 for i in range(25)}
+    assert {doc["$.join_type"] for doc in docs} == {"NotTracked"}
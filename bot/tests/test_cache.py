@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("discord")
+pytest.importorskip("redis.asyncio")
+
+from cache import InviteCache  # noqa: E402
+from cogs.attribution import assign_joins, diff_invites  # noqa: E402
+
+GUILD_ID = 1
+
+
+class FakeInvite:
+    def __init__(self, code: str, uses: int = 0, max_uses: int = 0):
+        self.code = code
+        self.uses = uses
+        self.max_uses = max_uses
+        self.inviter = None
+        self.channel = None
+        self.created_at = None
+        self.expires_at = None
+        self.temporary = False
+
+
+def snapshot(cache: InviteCache, *invites: FakeInvite) -> None:
+    cache.update(GUILD_ID, invites, overwrite=True)
+
+
+def test_invite_deleted_on_last_use_during_the_batch_window():
+    cache = InviteCache(None)
+    snapshot(cache, FakeInvite("single", 0, 1), FakeInvite("multi", 3))
+
+    # INVITE_DELETE for the used up invite arrives before the batch diffs
+    cache.discard(GUILD_ID, ["single"])
+    old = asyncio.run(cache.before_image(GUILD_ID))
+    snapshot(cache, FakeInvite("multi", 3))
+
+    deltas = diff_invites(old, cache.guilds[GUILD_ID])
+    assert deltas == {"single": 1}
+    assert assign_joins(deltas, 1) == ["single"]
+    # the snapshot took the delete into account, nothing is counted twice
+    assert not cache.tombstones.get(GUILD_ID)
+
+
+def test_before_image_is_not_mutated_by_later_events():
+    cache = InviteCache(None)
+    snapshot(cache, FakeInvite("a", 1), FakeInvite("b", 2))
+    old = asyncio.run(cache.before_image(GUILD_ID))
+    table = cache.guilds[GUILD_ID]
+
+    cache.discard(GUILD_ID, ["a"])
+    cache.update(GUILD_ID, [FakeInvite("c")])
+
+    assert set(old) == {"a", "b"}
+    assert set(table) == {"a", "b"}
+    assert set(cache.guilds[GUILD_ID]) == {"b", "c"}
+
+
+def test_forget_drops_tombstones():
+    cache = InviteCache(None)
+    snapshot(cache, FakeInvite("a", 0, 1))
+    cache.discard(GUILD_ID, ["a"])
+    cache.forget(GUILD_ID)
+    assert GUILD_ID not in cache.tombstones
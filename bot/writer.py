@@ -0,0 +1,129 @@
+import asyncio
+import time
+from collections import deque
+from logging import getLogger
+from typing import Deque, List, Optional, Tuple
+
+import redis.asyncio as redis
+from redis.exceptions import NoScriptError
+
+from scripts import LuaScript
+
+
+class EventWriter:
+    """Buffer the join and leave scripts of every guild
+
+    Handlers enqueue and return straight away, a single task flushes the
+    buffer as one pipeline of EVALSHAs every ``interval`` seconds or
+    ``batch`` events. The queue is bounded, once it's full handlers wait
+    for the next flush.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        *,
+        interval: float = 0.005,
+        batch: int = 500,
+        maxsize: int = 10000,
+    ):
+        self.redis = client
+        self.interval = interval
+        self.batch = batch
+        self.queue: "asyncio.Queue[Tuple]" = asyncio.Queue(maxsize)
+        self.flushes = 0
+        self.events = 0
+        self.batch_sizes: Deque[int] = deque(maxlen=1000)
+        self.flush_times: Deque[float] = deque(maxlen=1000)
+        self.log = getLogger("discord.app").getChild(type(self).__name__)
+        self._task: Optional[asyncio.Task] = None
+        self._current: Optional[asyncio.Future] = None
+        self._held: Optional[Tuple] = None
+
+    async def call(self, script: LuaScript, keys: List, args: List):
+        """Run a script as part of the next flush and return its result"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(("EVAL", script, keys, args, future))
+        return await future
+
+    async def enqueue(self, script: LuaScript, keys: List, args: List) -> None:
+        """Run a script as part of the next flush without waiting for it"""
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self._report)
+        await self.queue.put(("EVAL", script, keys, args, future))
+
+    def _report(self, future: asyncio.Future) -> None:
+        if not future.cancelled() and (e := future.exception()) is not None:
+            self.log.warning("Buffered script failed: %s", e)
+
+    async def _flush(self, batch: List[Tuple]) -> None:
+        start = time.perf_counter()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for _, script, keys, args, _ in batch:
+                pipe.execute_command("EVALSHA", script.sha, len(keys), *keys, *args)
+            try:
+                results = await pipe.execute(raise_on_error=False)
+            except Exception as e:
+                for op in batch:
+                    if not op[4].done():
+                        op[4].set_exception(e)
+                raise
+
+        for (_, script, keys, args, future), result in zip(batch, results):
+            if isinstance(result, NoScriptError):
+                # first call since redis restarted, EVAL loads it for next time
+                try:
+                    result = await self.redis.execute_command(
+                        "EVAL", script.source, len(keys), *keys, *args
+                    )
+                except Exception as e:  # pylint: disable=broad-except
+                    result = e
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+        self.flushes += 1
+        self.events += len(batch)
+        self.batch_sizes.append(len(batch))
+        self.flush_times.append(time.perf_counter() - start)
+
+    def _drain(self, first: Optional[Tuple] = None) -> List[Tuple]:
+        batch = [first] if first else []
+        while len(batch) < self.batch:
+            try:
+                batch.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            self._held = await self.queue.get()
+            if self.queue.qsize() < self.batch:
+                await asyncio.sleep(self.interval)
+            batch, self._held = self._drain(self._held), None
+            # shielded so close() never abandons a batch halfway
+            self._current = asyncio.ensure_future(self._flush(batch))
+            try:
+                await asyncio.shield(self._current)
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception("Failed to flush buffered writes")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stop the flush task and write out whatever is still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._current is not None and not self._current.done():
+            await asyncio.wait([self._current])
+        batch, self._held = self._drain(self._held), None
+        while batch:
+            await self._flush(batch)
+            batch = self._drain()
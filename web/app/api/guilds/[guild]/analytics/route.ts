@@ -20,10 +20,10 @@ const GET = async (request: NextRequest,
     // connect to redis
     const client = await connect();
 
-    // get the guild data from redis timeseries
+    // get the guild data from the hourly rollup the bot maintains
     const data = await client.execute([
         "TS.RANGE",
-        `guild:${guild_id}:members`,
+        `guild:${guild_id}:members:1h`,
         "-",
         "+",
         "+",
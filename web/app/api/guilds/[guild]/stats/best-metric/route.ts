@@ -1,10 +1,5 @@
-// REDIS COMMAND: 
-/* FT.AGGREGATE :models.Member:index "@guild:[641782804849491979 641782804849491979]"
-    GROUPBY 1 @join_type
-        REDUCE count 0 AS num_visits
-    SORTBY 2 @num_visits DESC
-    LIMIT 0 1
-*/
+// REDIS COMMAND:
+/* HMGET guild:641782804849491979:stats top_source top_source:count */
 
 
 import { connect } from "@/lib/redis";
@@ -33,40 +28,21 @@ const GET = async (request: NextRequest,
     // get the user from the session
     const { user } = await getSession(request, new NextResponse());
 
-    const best_metric = await client.execute([
-        "FT.AGGREGATE",
-        ":models.Member:index",
-        `@guild:[${guild_id} ${guild_id}]`,
-        "GROUPBY",
-        "1",
-        "@join_type",
-        "REDUCE",
-        "count",
-        "0",
-        "AS",
-        "num_visits",
-        "SORTBY",
-        "2",
-        "@num_visits",
-        "DESC",
-        "LIMIT",
-        "0",
-        "1"
-    ]) as [number, [
-        string,
-        string,
-        string,
-        number
-        ]];
-    if (best_metric.length <= 1) {
+    const [metric, hits] = await client.execute([
+        "HMGET",
+        `guild:${guild_id}:stats`,
+        "top_source",
+        "top_source:count"
+    ]) as [string | null, string | null];
+    if (!metric) {
         return NextResponse.json({
             metric: "N/A",
             hits: 0
         });
     }
     return NextResponse.json({
-            metric: best_metric[1][1],
-            hits: best_metric[1][3]
+            metric: metric,
+            hits: parseInt(hits || "0")
     } );
 };
 
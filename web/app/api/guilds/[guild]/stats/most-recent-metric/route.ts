@@ -5,10 +5,7 @@ import { NextRequest, NextResponse } from "next/server";
 
 /*
 Redis Command:
-FT.SEARCH :models.Member:index "@guild:[641782804849491979 641782804849491979]"
-    SORTBY ts DESC
-    LIMIT 0 1
-    
+HMGET guild:641782804849491979:stats last_join_type last_join_ts
 */
 
 const GET = async (request: NextRequest,
@@ -33,19 +30,14 @@ const GET = async (request: NextRequest,
     // get the user from the session
     const { user } = await getSession(request, new NextResponse());
 
-    const data = await client.execute([
-        "FT.SEARCH",
-        ":models.Member:index",
-        `@guild:[${guild_id} ${guild_id}]`,
-        "SORTBY",
-        "ts",
-        "DESC",
-        "LIMIT",
-        "0",
-        "1"
-    ]) as string[][];
+    const [join_type, ts] = await client.execute([
+        "HMGET",
+        `guild:${guild_id}:stats`,
+        "last_join_type",
+        "last_join_ts"
+    ]) as [string | null, string | null];
 
-    if (data.length <= 1) {
+    if (!join_type) {
         return NextResponse.json({
             data: {
                 join_type: "N/A",
@@ -53,7 +45,7 @@ const GET = async (request: NextRequest,
             }
         });
     }
-    return NextResponse.json({data: JSON.parse(data[2][3])})
+    return NextResponse.json({data: {join_type: join_type, ts: parseInt(ts || "0")}})
 };
 
 export { GET };
\ No newline at end of file
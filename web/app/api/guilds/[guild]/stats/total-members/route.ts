@@ -1,12 +1,5 @@
-// REDIS COMMAND: 
-/* FT.AGGREGATE :models.Member:index "@guild:[641782804849491979 641782804849491979]"
-    GROUPBY 1 @join_type
-        REDUCE count 0 AS num_visits
-    SORTBY 2 @num_visits DESC
-    LIMIT 0 1
-*/
-
-
+// REDIS COMMAND:
+/* HMGET guild:641782804849491979:stats members members:past */
 
 
 import { connect } from "@/lib/redis";
@@ -35,37 +28,20 @@ const GET = async (request: NextRequest,
     // get the user from the session
     const { user } = await getSession(request, new NextResponse());
 
-    const current_members = await client.execute([
-        "TS.GET",
-        `guild:${guild_id}:members`
-    ]) as [number, string] | [] || [];
-
-    // 4 weeks ago member count
-    const date = Date.now() - 2419200000;
-
-    const past_members = await client.execute([
-        "TS.RANGE",
-        `guild:${guild_id}:members`,
-        date,
-        "+",
-        "COUNT",
-        "1"
-    ]) as [number, string] | [] || [];
-
-    // console.log('total-members/route.js: ', past_members, current_members);
-    if (current_members.length === 0 || past_members.length === 0) {
-        return NextResponse.json({
-            current: 0,
-            past: 0,
-            diff: Date.now()
-        })
-    }
-    return NextResponse.json(
-        {
-            current: parseInt(current_members[1]),
-            past: parseInt(past_members[0][1]),
-            diff: past_members[0][0]
-        });
+    // materialized by the bot on every join and leave
+    const [members, past_members] = await client.execute([
+        "HMGET",
+        `guild:${guild_id}:stats`,
+        "members",
+        "members:past"
+    ]) as [string | null, string | null];
+
+    return NextResponse.json({
+        current: parseInt(members || "0"),
+        past: parseInt(past_members || members || "0"),
+        // the stats document covers the last 30 days
+        diff: Date.now() - 2592000000
+    });
 };
 
 export { GET };
\ No newline at end of file
@@ -44,8 +44,8 @@ const GET = async (request: NextRequest,
     const sortby = (searchParams.get("sort") || "ts").toLocaleLowerCase();
     const sortorder = (searchParams.get("order") || "DESC").toLocaleUpperCase();
 
-    // ensure sortby is one of [ts, display_name, created_at, joined_at, id, join_type, username, code_used]
-    if (["ts", "display_name", "created_at", "joined_at", "id", "join_type", "username", "code_used"].indexOf(sortby) === -1) {
+    // ensure sortby is one of the fields the bot's lean index profile indexes
+    if (["ts", "join_type", "code_used", "inviter", "display_name", "created_at"].indexOf(sortby) === -1) {
         const response = {
             status: "error",
             message: "invalid sortby"